@@ -0,0 +1,45 @@
+"""
+Compare Th123ReplayPacket.get_game_inputs with the former list-based decoder.
+Run with `python -m benchmarks.bench_game_inputs`.
+"""
+import os
+import timeit
+
+from cogs.common.networks import Th123ReplayPacket
+
+
+def legacy_get_game_inputs(packet):
+    offset = 10
+    reversed_inputs = [(packet[i+1], packet[i]) for i in range(offset, len(packet), 2)]
+    right_inputs = reversed([elem for tpl in reversed_inputs for elem in tpl])
+    return list(right_inputs)
+
+
+def make_packet(frames):
+    return Th123ReplayPacket(bytes(10) + os.urandom(2 * frames))
+
+
+def main(number=20):
+    for frames in (60, 600, 6000, 60000):
+        packet = make_packet(frames)
+        assert legacy_get_game_inputs(packet) == packet.get_game_inputs()
+
+        legacy = timeit.timeit(lambda: legacy_get_game_inputs(packet), number=number)
+        as_list = timeit.timeit(packet.get_game_inputs, number=number)
+        as_array = timeit.timeit(packet.get_game_inputs_array, number=number)
+        print(f'{frames:>6} frames: legacy {legacy / number * 1e6:10.1f}us'
+              f' list {as_list / number * 1e6:10.1f}us'
+              f' array {as_array / number * 1e6:10.1f}us'
+              f' (x{legacy / as_array:.0f})')
+
+    packets = [make_packet(600) for _ in range(100)]
+    legacy = timeit.timeit(
+        lambda: [i for p in packets for i in legacy_get_game_inputs(p)], number=number)
+    joined = timeit.timeit(
+        lambda: Th123ReplayPacket.join_game_inputs(packets), number=number)
+    print(f'100 chunks: legacy {legacy / number * 1e3:.2f}ms'
+          f' join {joined / number * 1e3:.2f}ms (x{legacy / joined:.0f})')
+
+
+if __name__ == '__main__':
+    main()
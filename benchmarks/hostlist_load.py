@@ -0,0 +1,208 @@
+"""
+Offline load test of HostListObserver against simulated th123 hosts.
+
+Every simulated host listens on its own localhost UDP port and answers the
+0x05 probe like the game does: 0x07 while waiting for an opponent, 0x08 while
+matching. Hosts can also flap or stay silent. The observer runs against a fake
+Discord channel, and for each scale the harness reports the tick duration,
+probe throughput, memory per post and hostlist message edits.
+Run with `python -m benchmarks.hostlist_load [--hosts 10 100 1000]`.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest.mock import patch
+
+from cogs import hosting
+from cogs.common import networks
+from cogs.common.channels import ChannelRegistry
+
+
+HOST_MODES = ('stable', 'watchable', 'matching', 'flap', 'silent')
+
+
+class SimulatedHost(asyncio.DatagramProtocol):
+    def __init__(self, mode, *, flap_period=timedelta(seconds=8)):
+        self.mode = mode
+        self.flap_period = flap_period.total_seconds()
+        self.started = time.monotonic()
+        self.probes = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def is_answering(self):
+        if self.mode == 'silent':
+            return False
+        if self.mode == 'flap':
+            return (time.monotonic() - self.started) // self.flap_period % 2 == 0
+        return True
+
+    def datagram_received(self, data, addr):
+        if data[0] != 0x05:
+            return
+        self.probes += 1
+        if not self.is_answering():
+            return
+
+        if self.mode == 'matching':
+            reply = networks.Th123Packet.packet_08(networks.IpPort.create(*addr))
+        else:
+            reply = networks.Th123Packet.packet_07(is_watchable=self.mode == 'watchable')
+        self.transport.sendto(reply, addr)
+
+
+class FakeMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, *, content):
+        self.channel.edits += 1
+        self.content = content
+
+    async def delete(self):
+        self.channel.deletes += 1
+
+
+class FakeChannel:
+    id = 1
+    name = "募集リスト-hostlist"
+
+    def __init__(self):
+        self.sends = 0
+        self.edits = 0
+        self.deletes = 0
+
+    async def send(self, content):
+        self.sends += 1
+        return FakeMessage(self, content)
+
+    async def history(self, limit):
+        for _ in ():
+            yield
+
+
+class FakeBot:
+    def __init__(self, channel):
+        self.channel = channel
+        self.channel_registry = ChannelRegistry(self)
+
+    def get_all_channels(self):
+        return [self.channel]
+
+
+class FakeUser:
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.id = next(self._ids)
+        self.mention = f"<@{self.id}>"
+
+    async def send(self, content):
+        pass
+
+
+async def start_hosts(count):
+    loop = asyncio.get_running_loop()
+    hosts = []
+    for i in range(count):
+        mode = HOST_MODES[i % len(HOST_MODES)]
+        transport, host = await loop.create_datagram_endpoint(
+            lambda: SimulatedHost(mode), local_addr=('127.0.0.1', 0))
+        hosts.append((networks.IpPort.create(*transport.get_extra_info('sockname')), host))
+    return hosts
+
+
+async def run(count, duration):
+    hosts = await start_hosts(count)
+    channel = FakeChannel()
+    observer = hosting.HostListObserver
+    tick_durations = []
+    tick = observer.tick
+
+    def timed_tick():
+        started = time.perf_counter()
+        tick()
+        tick_durations.append(time.perf_counter() - started)
+
+    with patch.object(observer, '_registry', hosting.HostRegistry()), \
+            patch.object(observer, '_closing', set()), \
+            patch.object(observer, '_timer_wheel', networks.TimerWheel()), \
+            patch.object(observer, '_changed', asyncio.Event()), \
+            patch.object(observer, '_outbox', hosting.NotificationOutbox()), \
+            patch.object(observer, '_multiplexer', None), \
+            patch.object(observer, '_multiplexer_lock', asyncio.Lock()), \
+            patch.object(observer, 'tick', timed_tick):
+        task = asyncio.ensure_future(observer.task_func(FakeBot(channel)))
+        await asyncio.sleep(0)
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for ipport, host in hosts:
+            protocol = hosting.Th123HostProtocol(
+                ipport, networks.Th123Packet.packet_05(sokuroll_uses=random.random() < .2))
+            user = FakeUser()
+            post = hosting.HostPostAsset(
+                user, f"{user.mention}, {ipport} | {host.mode} host", protocol)
+            await observer.append(post)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        memory = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+        started_edits = channel.edits + channel.sends
+        await asyncio.sleep(duration)
+        multiplexer = observer._multiplexer
+        probe_rate = multiplexer.scheduler.probe_rate()
+        remaining = len(observer._registry)
+
+        task.cancel()
+        await asyncio.sleep(0)
+        observer._outbox.close()
+        multiplexer.transport.close()
+
+    for _, host in hosts:
+        host.transport.close()
+
+    return {
+        'hosts': count,
+        'remaining': remaining,
+        'tick_mean_ms': statistics.mean(tick_durations) * 1e3 if tick_durations else 0,
+        'tick_max_ms': max(tick_durations, default=0) * 1e3,
+        'probe_rate': probe_rate,
+        'bytes_per_post': memory / count,
+        'edits': channel.edits + channel.sends - started_edits,
+        'edits_per_min': (channel.edits + channel.sends - started_edits) * 60 / duration,
+    }
+
+
+async def main(scales, duration):
+    print(f"{'hosts':>6} {'alive':>6} {'tick ms':>9} {'max ms':>8} "
+          f"{'probes/s':>9} {'B/post':>8} {'edits':>6} {'edits/min':>9}")
+    for count in scales:
+        result = await run(count, duration)
+        print(f"{result['hosts']:>6} {result['remaining']:>6} "
+              f"{result['tick_mean_ms']:>9.3f} {result['tick_max_ms']:>8.3f} "
+              f"{result['probe_rate']:>9.1f} {result['bytes_per_post']:>8.0f} "
+              f"{result['edits']:>6} {result['edits_per_min']:>9.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = max(args.hosts) + 64
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+    asyncio.run(main(args.hosts, args.duration))
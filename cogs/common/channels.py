@@ -0,0 +1,73 @@
+from typing import Any, Dict
+
+
+class ChannelRegistry:
+    """
+    Indexes the guild channels by id and by name once, and keeps the index up
+    to date from the guild channel events, so cogs look channels up without
+    scanning the guild. Webhooks are fetched once per channel.
+    """
+    NAMES = {
+        'hostlist': "募集リスト-hostlist",
+        'jp-en': "jp-en",
+        'en-jp': "en-jp",
+        'information': "ご利用案内・ルール",
+        'entrance': "サーバー玄関口・雑談",
+    }
+
+    def __init__(self, bot: Any, names: Dict[str, str]=None) -> None:
+        self._bot = bot
+        self._names = dict(self.NAMES if names is None else names)
+        self._by_id = {}
+        self._ids = {}
+        self._webhooks = {}
+        self._resolved = False
+
+    def resolve(self):
+        self._by_id.clear()
+        self._ids.clear()
+        self._webhooks.clear()
+        for channel in self._bot.get_all_channels():
+            self.add(channel)
+        self._resolved = True
+
+    def get(self, name: str) -> Any:
+        """Returns the channel for a registered key such as 'hostlist', or for a channel name."""
+        if not self._resolved:
+            self.resolve()
+        channel_id = self._ids.get(self._names.get(name, name))
+        return self._by_id.get(channel_id)
+
+    def get_by_id(self, channel_id: int) -> Any:
+        if not self._resolved:
+            self.resolve()
+        return self._by_id.get(channel_id)
+
+    async def webhook(self, name: str) -> Any:
+        channel = self.get(name)
+        if channel is None:
+            return None
+        if channel.id not in self._webhooks:
+            self._webhooks[channel.id] = (await channel.webhooks())[0]
+        return self._webhooks[channel.id]
+
+    def add(self, channel: Any):
+        self._by_id[channel.id] = channel
+        self._ids.setdefault(channel.name, channel.id)
+
+    def remove(self, channel: Any):
+        self._by_id.pop(channel.id, None)
+        self._webhooks.pop(channel.id, None)
+        if self._ids.get(channel.name) == channel.id:
+            del self._ids[channel.name]
+            for other in self._by_id.values():
+                if other.name == channel.name:
+                    self._ids[channel.name] = other.id
+                    break
+
+    def update(self, before: Any, after: Any):
+        self.remove(before)
+        self.add(after)
+
+    def invalidate_webhooks(self, channel: Any):
+        self._webhooks.pop(channel.id, None)
@@ -1,38 +1,206 @@
-from datetime import (datetime, timedelta)
+from array import array
+from datetime import timedelta
 from ipaddress import IPv4Address as ipv4
 from typing import Any, Iterable, Tuple, List
 import unicodedata
+import collections
+import functools
+import struct
+import time
 from enum import Enum
 
 
 class Lifetime:
+    __slots__ = ('lifetime', '_lifetime_ns', 'deadline', '_wheel')
+
     def __init__(self, lifetime: timedelta):
         self.lifetime = lifetime
+        self._lifetime_ns = lifetime // timedelta(microseconds=1) * 1000
+        self._wheel = None
         self.reset()
 
     def reset(self):
-        self.ack_datetime = datetime.now()
+        self.deadline = time.monotonic_ns() + self._lifetime_ns
+        if self._wheel is not None:
+            self._wheel.touch(self)
 
-    def elapsed_datetime(self):
-        return datetime.now() - self.ack_datetime
+    def elapsed_datetime(self) -> timedelta:
+        elapsed_ns = time.monotonic_ns() - self.deadline + self._lifetime_ns
+        return timedelta(microseconds=elapsed_ns // 1000)
 
     def is_expired(self):
-        return self.elapsed_datetime() >= self.lifetime
+        return time.monotonic_ns() >= self.deadline
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel over Lifetime deadlines.
+    advance() returns the keys of lifetimes that expired since the previous
+    call. Resetting a lifetime calls touch(), which only re-inserts a lifetime
+    that has already expired out of the wheel; a lifetime still in a slot stays
+    there and is moved to its new slot lazily when its old slot comes round.
+    """
+    def __init__(self, tick: timedelta=timedelta(seconds=1), size: int=64):
+        self._tick_ns = tick // timedelta(microseconds=1) * 1000
+        self._slots = [set() for _ in range(size)]
+        self._keys = {}
+        self._slot_of = {}
+        self._current = time.monotonic_ns() // self._tick_ns
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def schedule(self, lifetime: Lifetime, key: Any):
+        lifetime._wheel = self
+        self._keys[lifetime] = key
+        self.touch(lifetime)
+
+    def cancel(self, lifetime: Lifetime):
+        lifetime._wheel = None
+        self._keys.pop(lifetime, None)
+        index = self._slot_of.pop(lifetime, None)
+        if index is not None:
+            self._slots[index].discard(lifetime)
+
+    def touch(self, lifetime: Lifetime):
+        if lifetime not in self._slot_of:
+            self._insert(lifetime, max(lifetime.deadline // self._tick_ns, self._current))
+
+    def _insert(self, lifetime: Lifetime, tick: int):
+        index = tick % len(self._slots)
+        self._slots[index].add(lifetime)
+        self._slot_of[lifetime] = index
+
+    def advance(self, now: int=None) -> List[Any]:
+        now = time.monotonic_ns() if now is None else now
+        target = now // self._tick_ns
+        expired = []
+        ticks = min(target - self._current + 1, len(self._slots))
+        for tick in range(self._current, self._current + ticks):
+            index = tick % len(self._slots)
+            for lifetime in list(self._slots[index]):
+                if lifetime.deadline <= now:
+                    self._slots[index].discard(lifetime)
+                    del self._slot_of[lifetime]
+                    expired.append(self._keys[lifetime])
+                    continue
+
+                deadline_tick = lifetime.deadline // self._tick_ns
+                if deadline_tick % len(self._slots) != index:
+                    self._slots[index].discard(lifetime)
+                    self._insert(lifetime, deadline_tick)
+        self._current = target
+        return expired
+
+
+class LinkQuality:
+    """
+    Round trip time of probes, smoothed with the RFC 6298 estimator along with
+    its jitter, and the share of the last `window` probes left unanswered.
+    Replies carry no sequence number, so following Karn's algorithm a reply
+    received after a probe was sent again is not used as an RTT sample.
+    """
+    __slots__ = ('srtt', 'rttvar', '_sent', '_resent', '_losses', '_shown')
+
+    def __init__(self, window: int=20):
+        self.srtt = None
+        self.rttvar = None
+        self._sent = None
+        self._resent = False
+        self._losses = collections.deque(maxlen=window)
+        self._shown = None
+
+    def sent(self, now: int=None):
+        if self._sent is not None:
+            self._resent = True
+            self._losses.append(True)
+            self._sample()
+        self._sent = time.monotonic_ns() if now is None else now
+
+    def received(self, now: int=None) -> bool:
+        """Returns True if the reply gave an RTT sample."""
+        if self._sent is None:
+            return False
+
+        rtt = (time.monotonic_ns() if now is None else now) - self._sent
+        resent = self._resent
+        self._sent = None
+        self._resent = False
+        self._losses.append(False)
+        if not resent:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self._sample()
+        return not resent
+
+    def loss(self) -> float:
+        if not self._losses:
+            return 0.0
+        return sum(self._losses) / len(self._losses)
+
+    def _sample(self):
+        # The shown values only move on a noticeable change, so that the
+        # hostlist is not edited for every few milliseconds of jitter.
+        if self.srtt is None:
+            return
+
+        rtt = self.srtt / 1e6
+        loss = self.loss()
+        if (self._shown is None
+                or abs(rtt - self._shown[0]) > max(self._shown[0] * .2, 10)
+                or abs(loss - self._shown[1]) >= .1):
+            self._shown = (rtt, loss)
+
+    def indicator(self) -> str:
+        if self._shown is None:
+            return str()
+
+        rtt, loss = self._shown
+        if loss > 0:
+            return f"`{rtt:.0f}ms {loss:.0%}lost`"
+        return f"`{rtt:.0f}ms`"
+
+
+_IPPORT = struct.Struct('>HI')
 
 
 class IpPort:
+    __slots__ = ('_key', '_tuple', '_str', '_bytes')
     __construct_key = object()
 
-    def __init__(self, ip: ipv4, port: int, *, key: object) -> None:
+    _interned = collections.OrderedDict()
+    _interned_size = 1024
+
+    def __init__(self, ip: int, port: int, *, key: object) -> None:
         assert key == self.__construct_key, \
             'PortIp object must be created using PortIp.create methods'
 
-        self._ip = ip
-        self._port = port
+        self._key = ip << 16 | port
+        self._tuple = None
+        self._str = None
+        self._bytes = None
 
     @classmethod
     def create(cls, ip: Any, port: Any) -> 'IpPort':
-        return IpPort(ipv4(ip), int(port), key=cls.__construct_key)
+        # Receive paths create an IpPort per datagram from the same few peers.
+        interned = cls._interned
+        ipport = interned.get((ip, port))
+        if ipport is not None:
+            interned.move_to_end((ip, port))
+            return ipport
+
+        port_number = int(port)
+        if not 0 <= port_number <= 0xffff:
+            raise ValueError(f"port out of range: {port}")
+        ipport = IpPort(int(ipv4(ip)), port_number, key=cls.__construct_key)
+        interned[(ip, port)] = ipport
+        if len(interned) > cls._interned_size:
+            interned.popitem(last=False)
+        return ipport
 
     @classmethod
     def create_with_str(cls, ip_port: str) -> 'IpPort':
@@ -41,28 +209,44 @@ class IpPort:
         port = int(port)
         if port not in range(0x0000, 0xffff):
             raise ValueError
-        return IpPort(ip, port, key=cls.__construct_key)
+        return IpPort(int(ip), port, key=cls.__construct_key)
 
     @classmethod
     def create_with_bin(cls, port_ip: bytes) -> 'IpPort':
-        port, ip = (int.from_bytes(port_ip[:2], 'big'), ipv4(port_ip[2:]))
+        port, ip = _IPPORT.unpack(port_ip)
         return IpPort(ip, port, key=cls.__construct_key)
 
     def ipaddr(self) -> ipv4:
-        return self._ip
+        return ipv4(self._key >> 16)
 
     def port(self) -> int:
-        return self._port
+        return self._key & 0xffff
 
     def __str__(self) -> str:
-        return f'{self._ip.exploded}:{self._port}'
+        if self._str is None:
+            self._str = '{}:{}'.format(*self)
+        return self._str
+
+    def __repr__(self) -> str:
+        return f'IpPort({self})'
 
     def __bytes__(self) -> bytes:
-        return self.port().to_bytes(2, 'big') + self._ip.packed
+        if self._bytes is None:
+            self._bytes = _IPPORT.pack(self.port(), self._key >> 16)
+        return self._bytes
 
     def __iter__(self) -> Iterable:
-        yield self._ip.exploded
-        yield self._port
+        if self._tuple is None:
+            self._tuple = (self.ipaddr().exploded, self.port())
+        return iter(self._tuple)
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, IpPort):
+            return NotImplemented
+        return self._key == other._key
 
 
 class Th123ReplayPacket(bytes):
@@ -78,11 +262,132 @@ class Th123ReplayPacket(bytes):
     def get_inputs_count(self) -> int:
         return self[9]
 
+    def get_game_inputs_array(self) -> array:
+        # Inputs arrive newest first; reversing the 16-bit words restores
+        # frame order while keeping each word's byte order.
+        game_inputs = array('H')
+        game_inputs.frombytes(memoryview(self)[10:])
+        game_inputs.reverse()
+        return game_inputs
+
     def get_game_inputs(self) -> List[int]:
-        offset = 10
-        reversed_inputs = [(self[i+1], self[i]) for i in range(offset, len(self), 2)]
-        right_inputs = reversed([elem for tpl in reversed_inputs for elem in tpl])
-        return right_inputs
+        return list(self.get_game_inputs_array().tobytes())
+
+    @staticmethod
+    def join_game_inputs(packets: Iterable['Th123ReplayPacket']) -> array:
+        game_inputs = array('H')
+        for packet in packets:
+            game_inputs += packet.get_game_inputs_array()
+        return game_inputs
+
+
+_SOCKADDR_IN = '2s6s8x'
+_AF_INET = b'\x02\x00'
+_PACKET_01 = struct.Struct('<B' + _SOCKADDR_IN + _SOCKADDR_IN + '4x')
+_PACKET_02 = struct.Struct('<B' + _SOCKADDR_IN + '4x')
+_PACKET_04 = struct.Struct('<BI')
+_PACKET_05 = struct.Struct('<BB15s4xIBB24s14x')
+_PACKET_06 = struct.Struct('<B4xII24s8x24s12x')
+_PACKET_08 = struct.Struct('<BI' + _SOCKADDR_IN + '48s')
+_PACKET_ACK = struct.Struct('<BBIBB')
+_PACKET_0E_REPLAY_REQUEST = struct.Struct('<BBIB')
+
+_PACKET_05_SIGNATURE = bytes.fromhex('7365d9' 'ffc46e48' '8d7ca192' '31347295')
+# This packet might just be garbage, goodness knows that.
+_PACKET_08_TRAILER = bytes.fromhex(
+    '70000000' '0000060c' '00000000' '00100000' '00000000' '00010e03'
+    '97ce0010' '10101010' '10000000' '010d0905' '0e010000' '00100000')
+
+
+def decode_profile_name(raw: bytes) -> str:
+    end = raw.find(b'\0')
+    if end >= 0:
+        raw = raw[:end]
+    return raw.decode('shift-jis')
+
+
+class PacketSchema:
+    """
+    Describes a fixed packet layout as (field name, struct format) pairs and
+    decodes it with a single struct.unpack_from into an immutable record.
+    A field named None is padding, and a trailing '*' field receives the rest
+    of the buffer as a memoryview.
+    """
+    _registry = {}
+
+    def __init__(self, record_name: str, key: int, fields: List[Tuple[str, str]]):
+        self.key = key
+        self._tail = None
+        if fields[-1][1] == '*':
+            self._tail = fields[-1][0]
+            fields = fields[:-1]
+
+        self._struct = struct.Struct('<' + ''.join(fmt for _, fmt in fields))
+        self._groups = []
+        names = []
+        start = 0
+        for name, fmt in fields:
+            count = len(struct.unpack('<' + fmt, bytes(struct.calcsize('<' + fmt))))
+            if name is not None:
+                names.append(name)
+                self._groups.append((start, start + count) if count > 1 else start)
+            start += count
+        self._flat = all(isinstance(group, int) for group in self._groups) and start == len(names)
+
+        if self._tail is not None:
+            names.append(self._tail)
+        self.record = collections.namedtuple(record_name, names)
+        self._registry[key] = self
+
+    @property
+    def size(self) -> int:
+        return self._struct.size
+
+    def decode(self, buffer: Any, offset: int=0) -> Any:
+        if len(buffer) - offset < self._struct.size:
+            return None
+        values = self._struct.unpack_from(buffer, offset)
+        if not self._flat:
+            values = [values[group] if isinstance(group, int) else values[group[0]:group[1]]
+                      for group in self._groups]
+        if self._tail is not None:
+            values = (*values, memoryview(buffer)[offset + self._struct.size:])
+        return self.record._make(values)
+
+    @classmethod
+    def lookup(cls, buffer: Any) -> 'PacketSchema':
+        if len(buffer) == 0:
+            return None
+        header = buffer[0]
+        if header in (0x0d, 0x0e):
+            if len(buffer) < 2:
+                return None
+            return cls._registry.get(header << 8 | buffer[1])
+        return cls._registry.get(header)
+
+
+Packet01Record = PacketSchema('Packet01Record', 0x01, [
+    ('header', 'B'), (None, '2x'), ('ipport', '6s'), (None, '10x'),
+    ('ipport_2p', '6s'), (None, '12x')]).record
+Packet02Record = PacketSchema('Packet02Record', 0x02, [
+    ('header', 'B'), (None, '2x'), ('ipport', '6s'), (None, '12x')]).record
+Packet05Record = PacketSchema('Packet05Record', 0x05, [
+    ('header', 'B'), ('soku_id', 'B'), (None, '23x'), ('matching', '?'),
+    ('profile_name_length', 'B'), ('profile_name', '24s'), (None, '14x')]).record
+Packet06Record = PacketSchema('Packet06Record', 0x06, [
+    ('header', 'B'), (None, '12x'), ('profile_name', '24s'), (None, '8x'),
+    ('profile_2p_name', '24s'), (None, '12x')]).record
+Packet08Record = PacketSchema('Packet08Record', 0x08, [
+    ('header', 'B'), ('matching', 'I'), (None, '2x'), ('ipport', '6s')]).record
+MatchHeaderRecord = PacketSchema('MatchHeaderRecord', 0x0d04, [
+    ('header', 'B'), ('detail', 'B'),
+    ('character_1p', 'B'), ('color_1p', 'B'), (None, 'x'), ('deck_size_1p', 'B'),
+    ('deck_1p', '20H'), ('simultaneous_button_1p', 'B'),
+    ('character_2p', 'B'), ('color_2p', 'B'), (None, 'x'), ('deck_size_2p', 'B'),
+    ('deck_2p', '20H'), ('simultaneous_button_2p', 'B'),
+    ('stage', 'B'), ('bgm', 'B'), ('seed', 'I'), ('matching_count', 'B')]).record
+ReplayChunkRecord = PacketSchema('ReplayChunkRecord', 0x0d09, [
+    ('header', 'B'), ('detail', 'B'), (None, 'x'), ('payload', '*')]).record
 
 
 class Th123Packet(bytes):
@@ -93,112 +398,101 @@ class Th123Packet(bytes):
         first_ipport: IpPort,
         second_ipport: IpPort,
     ) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '01'
-            f'0200{bytes(first_ipport).hex()}' '00000000' '00000000'
-            f'0200{bytes(second_ipport).hex()}' '00000000' '00000000'
-            '00000000'))
+        return Th123Packet(_PACKET_01.pack(
+            0x01,
+            _AF_INET, bytes(first_ipport),
+            _AF_INET, bytes(second_ipport)))
 
     @staticmethod
     def packet_02(ipport: IpPort) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '02'
-            f'0200{bytes(ipport).hex()}' '00000000' '00000000'
-            '00000000'))
+        return Th123Packet(_PACKET_02.pack(0x02, _AF_INET, bytes(ipport)))
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def packet_03() -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex('03'))
+        return Th123Packet(b'\x03')
 
     @staticmethod
     def packet_04(data: int) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '04'
-            f'{data.to_bytes(4, "little").hex()}'))
+        return Th123Packet(_PACKET_04.pack(0x04, data))
 
     @staticmethod
+    @functools.lru_cache(maxsize=32)
     def packet_05(
         *,
         sokuroll_uses: bool=False,
         should_match: bool=False,
         profile_name: str=str(),
     ) -> 'Th123Packet':
-        soku_id_byte = '64' if sokuroll_uses else '6e'
-        profile_name_bytes = str.encode(profile_name, 'shift-jis')
-        return Th123Packet(bytes.fromhex(
-            '05'
-            f'{soku_id_byte}7365d9' 'ffc46e48' '8d7ca192' '31347295'
-            '00000000' '28000000'
-            f'{int(should_match):02}'
-            f'{len(profile_name_bytes).to_bytes(1, "big").hex()}'
-            f'{profile_name_bytes.hex():0<48}'
-            '00000000' '00000000' '00000000' '0000'))
+        profile_name_bytes = str.encode(profile_name, 'shift-jis')[:24]
+        return Th123Packet(_PACKET_05.pack(
+            0x05,
+            0x64 if sokuroll_uses else 0x6e,
+            _PACKET_05_SIGNATURE,
+            0x28,
+            int(should_match),
+            len(profile_name_bytes),
+            profile_name_bytes))
 
     @staticmethod
+    @functools.lru_cache(maxsize=32)
     def packet_06(
         *,
         profile_1p_name: str='Shanghai',
         profile_2p_name: str=str()
     ) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '06'
-            '00000000' '10000000' '44000000'
-            f'{str.encode(profile_1p_name, "shift-jis").hex():0<48}'
-            '00000000' '00000000'
-            f'{str.encode(profile_2p_name, "shift-jis").hex():0<48}'
-            '00000000' '00000000'
-            '00000000'))
+        return Th123Packet(_PACKET_06.pack(
+            0x06, 0x10, 0x44,
+            str.encode(profile_1p_name, 'shift-jis'),
+            str.encode(profile_2p_name, 'shift-jis')))
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def packet_07(*, is_watchable: bool=False) -> 'Th123Packet':
-        if is_watchable:
-            return Th123Packet(bytes.fromhex('07' '01000000'))
-        else:
-            return Th123Packet(bytes.fromhex('07' '00000000'))
+        return Th123Packet(_PACKET_04.pack(0x07, int(is_watchable)))
 
     @staticmethod
     def packet_08(ipport: IpPort) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '08'
-            '01000000'
-            f'0200{bytes(ipport).hex()}' '00000000' '00000000'
-            # This packet might just be garbage, goodness knows that.
-            '70000000' '0000060c' '00000000' '00100000' '00000000' '00010e03'
-            '97ce0010' '10101010' '10000000' '010d0905' '0e010000' '00100000'))
+        return Th123Packet(_PACKET_08.pack(
+            0x08, 0x01, _AF_INET, bytes(ipport), _PACKET_08_TRAILER))
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def packet_0b() -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex('0b'))
+        return Th123Packet(b'\x0b')
+
+    @staticmethod
+    def _packet_ack(header: int, ack: int, count: int) -> 'Th123Packet':
+        buffer = bytearray(_PACKET_ACK.size + 2 * count)
+        _PACKET_ACK.pack_into(buffer, 0, header, 0x03, ack, 0x03, count)
+        return Th123Packet(buffer)
 
     @staticmethod
     def packet_0d(ack: int, count: int=2) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '0d'
-            f'03{ack.to_bytes(4, "little").hex()}03'
-            f'{count.to_bytes(1, "little").hex()}' f'{"0000" * count}'))
+        return Th123Packet._packet_ack(0x0d, ack, count)
 
     @staticmethod
     def packet_0e(ack: int, count: int=1) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(
-            '0e'
-            f'03{ack.to_bytes(4, "little").hex()}03'
-            f'{count.to_bytes(1, "little").hex()}' f'{"0000" * count}'))
+        return Th123Packet._packet_ack(0x0e, ack, count)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def packet_0d_sp() -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex('0d' '0203'))
+        return Th123Packet(b'\x0d\x02\x03')
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def packet_0e_sp() -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex('0e' '0103'))
+        return Th123Packet(b'\x0e\x01\x03')
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def packet_0e_watch() -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex('0e0bffffffff00'))
+        return Th123Packet.packet_0e_replay_request(0xffffffff, 0x00)
 
     @staticmethod
     def packet_0e_replay_request(frame: int, count: int) -> 'Th123Packet':
-        return Th123Packet(bytes.fromhex(f'0e0b{frame.to_bytes(4, "little").hex()}{count.to_bytes(1, "little").hex()}'))
+        return Th123Packet(_PACKET_0E_REPLAY_REQUEST.pack(0x0e, 0x0b, frame, count))
 
     def get_header(self) -> int:
         if len(self) > 0:
@@ -210,47 +504,38 @@ class Th123Packet(bytes):
             return int.from_bytes(self[0:2], 'big')
         return None
 
+    @functools.cached_property
+    def decoded(self) -> Any:
+        schema = PacketSchema.lookup(self)
+        if schema is None:
+            return None
+        return schema.decode(self)
+
     def get_ipport(self) -> IpPort:
-        if self.get_header() == 0x01:
-            return IpPort.create_with_bin(self[3:9])
-        if self.get_header() == 0x02:
-            return IpPort.create_with_bin(self[3:9])
-        if self.get_header() == 0x08:
-            return IpPort.create_with_bin(self[7:13])
+        if self.get_header() in (0x01, 0x02, 0x08) and self.decoded:
+            return IpPort.create_with_bin(self.decoded.ipport)
         return None
 
     def get_2p_ipport(self) -> IpPort:
-        if self.get_header() == 0x01:
-            return IpPort.create_with_bin(self[19:25])
+        if self.get_header() == 0x01 and self.decoded:
+            return IpPort.create_with_bin(self.decoded.ipport_2p)
 
     def get_matching_flag(self) -> bool:
-        if self.get_header() == 0x05:
-            return bool(self[25])
+        if self.get_header() == 0x05 and self.decoded:
+            return self.decoded.matching
         return None
 
     def get_profile_name(self) -> str:
-        if self.get_header() == 0x05:
-            profile_length = self[26]
-            return self[27:27 + profile_length].decode('shift-jis')
-        if self.get_header() == 0x06:
-            raws = []
-            for raw in self[13:]:
-                if raw == 0x00:
-                    break
-                raws.append(raw)
-            profile = bytearray(raws).decode('shift-jis')
-            return profile
+        if self.get_header() == 0x05 and self.decoded:
+            profile_name = self.decoded.profile_name
+            return profile_name[:self.decoded.profile_name_length].decode('shift-jis')
+        if self.get_header() == 0x06 and self.decoded:
+            return decode_profile_name(self.decoded.profile_name)
         return None
 
     def get_2p_profile_name(self) -> str:
-        if self.get_header() == 0x06:
-            raws = []
-            for raw in self[45:]:
-                if raw == 0x00:
-                    break
-                raws.append(raw)
-            profile = bytearray(raws).decode('shift-jis')
-            return profile
+        if self.get_header() == 0x06 and self.decoded:
+            return decode_profile_name(self.decoded.profile_2p_name)
         return None
 
     def get_ack_count(self) -> int:
@@ -260,55 +545,161 @@ class Th123Packet(bytes):
             return int.from_bytes(self[2:6], 'little')
         return None
 
-    def get_characters(self) -> Tuple[int, int]:
+    def get_match_header(self) -> 'MatchHeaderRecord':
         if self.get_detail_header() == 0x0d04:
-            return (self[2], self[47])
+            return self.decoded
+        return None
+
+    def get_characters(self) -> Tuple[int, int]:
+        header = self.get_match_header()
+        if header:
+            return (header.character_1p, header.character_2p)
         return None
 
     def get_colors(self) -> Tuple[int, int]:
-        if self.get_detail_header() == 0x0d04:
-            return (self[3], self[48])
+        header = self.get_match_header()
+        if header:
+            return (header.color_1p, header.color_2p)
 
     def get_stage(self) -> int:
-        if self.get_detail_header() == 0x0d04:
-            return self[92]
+        header = self.get_match_header()
+        if header:
+            return header.stage
 
     def get_bgm(self) -> int:
-        if self.get_detail_header() == 0x0d04:
-            return self[93]
+        header = self.get_match_header()
+        if header:
+            return header.bgm
 
     def get_simultaneous_buttons(self) -> Tuple[int, int]:
-        if self.get_detail_header() == 0x0d04:
-            return (self[46], self[91])
+        header = self.get_match_header()
+        if header:
+            return (header.simultaneous_button_1p, header.simultaneous_button_2p)
 
     def get_deck_sizes(self) -> Tuple[int, int]:
-        if self.get_detail_header() == 0x0d04:
-            return (self[5], self[50])
+        header = self.get_match_header()
+        if header:
+            return (header.deck_size_1p, header.deck_size_2p)
 
     def get_1p_decks(self) -> deck:
-        if self.get_detail_header() == 0x0d04:
-            offset = 6
-            end = 2 * 20 + offset
-            return [self[i:i+2] for i in range(offset, end, 2)]
+        header = self.get_match_header()
+        if header:
+            return header.deck_1p
         return None
 
     def get_2p_decks(self) -> deck:
-        if self.get_detail_header() == 0x0d04:
-            offset = 51
-            end = 2 * 20 + offset
-            return [self[i:i+2] for i in range(offset, end, 2)]
+        header = self.get_match_header()
+        if header:
+            return header.deck_2p
         return None
 
     def get_seed(self) -> int:
-        if self.get_detail_header() == 0x0d04:
-            return int.from_bytes(self[94:98], 'little')
+        header = self.get_match_header()
+        if header:
+            return header.seed
 
     def get_matching_count(self) -> int:
-        if self.get_detail_header() == 0x0d04:
-            return self[98]
+        header = self.get_match_header()
+        if header:
+            return header.matching_count
         return None
 
 
+class Th123Dispatcher:
+    """
+    Routes datagrams through a 256-entry table indexed by the header byte, and
+    through a second table indexed by the next byte for the 0x0d/0x0e detail
+    headers. Handlers are registered with route() and called as
+    handler(owner, data, *args); datagrams without a handler are counted.
+    """
+    def __init__(self):
+        self._table = [None] * 256
+        self._detail_tables = [None] * 256
+        for header in (0x0d, 0x0e):
+            self._detail_tables[header] = [None] * 256
+        self.unknown = collections.Counter()
+
+    def route(self, header: int):
+        def decorator(handler):
+            if header > 0xff:
+                self._detail_tables[header >> 8][header & 0xff] = handler
+            else:
+                self._table[header] = handler
+            return handler
+        return decorator
+
+    def dispatch(self, owner: Any, data: Any, *args: Any) -> bool:
+        if len(data) == 0:
+            self.unknown[None] += 1
+            return False
+
+        header = data[0]
+        handler = None
+        detail_table = self._detail_tables[header]
+        if detail_table is not None and len(data) > 1:
+            handler = detail_table[data[1]]
+        if handler is None:
+            handler = self._table[header]
+        if handler is None:
+            self.unknown[header] += 1
+            return False
+
+        handler(owner, data, *args)
+        return True
+
+
+class HostStatus:
+    dispatcher = Th123Dispatcher()
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hosting = False
+        self.matching = False
+        self.watchable = False
+
+    def __call__(self, packet):
+        if not self.dispatcher.dispatch(self, packet):
+            self.reset()
+
+    @dispatcher.route(0x07)
+    def _on_host_info(self, packet):
+        if len(packet) < 2 or packet[1] not in (0x00, 0x01):
+            self.reset()
+            return
+
+        self.hosting = True
+        self.matching = False
+        self.watchable = packet[1] == 0x01
+
+    @dispatcher.route(0x08)
+    def _on_redirect(self, packet):
+        if len(packet) < 2 or packet[1] != 0x01:
+            self.reset()
+            return
+
+        self.hosting = True
+        self.matching = True
+
+    def astuple(self) -> Tuple[bool, bool, bool]:
+        return (self.hosting, self.matching, self.watchable)
+
+    def is_unknown(self):
+        return (
+            not self.hosting and
+            not self.matching and
+            not self.watchable)
+
+    def __str__(self):
+        if self.is_unknown():
+            return ":question:"
+
+        return " ".join([
+            ":crossed_swords:" if self.matching else ":o:",
+            ":eye:" if self.watchable else ":see_no_evil:"])
+
+
 if __name__ == '__main__':
     import argparse
     import binascii
@@ -1,6 +1,8 @@
+from array import array
 from datetime import datetime
 import dataclasses
-from typing import List, Tuple
+import struct
+from typing import Tuple
 
 id2characcter_hash = {
     0: 'reimu',
@@ -69,14 +71,12 @@ class Th123ReplayBuilder:
         self.replay[0x41] = p2
 
     def set_decks(self, p1, p2):
-        expanded_p1 = [b1 for b2 in p1 for b1 in b2]
-        expanded_p2 = [b1 for b2 in p2 for b1 in b2]
         p1_offset = 0x14
         p1_end = 0x14 + 40
         p2_offset = 0x45
         p2_end = 0x45 + 40
-        self.replay[p1_offset:p1_end] = expanded_p1
-        self.replay[p2_offset:p2_end] = expanded_p2
+        self.replay[p1_offset:p1_end] = struct.pack('<20H', *p1)
+        self.replay[p2_offset:p2_end] = struct.pack('<20H', *p2)
 
     def _set_positions(self):
         self.replay[0x3c] = 0
@@ -99,7 +99,7 @@ class Th123ReplayBuilder:
         self.replay[0x77:0x79] = size.to_bytes(4, 'little')
 
     def set_inputs(self, game_inputs):
-        self.replay += game_inputs
+        self.replay += bytes(game_inputs)
 
     def build_replay(self, replay_meta):
         self.set_date(replay_meta.date)
@@ -131,6 +131,6 @@ class Th123ReplayMeta():
     bgm: int = dataclasses.field(default=0, init=False)
     seed: Tuple[int, int, int, int] = dataclasses.field(default=(0, 0, 0, 0), init=False)
     input_size: int = dataclasses.field(default=0, init=False)
-    game_inputs: List[int] = dataclasses.field(default_factory=list, init=False)
+    game_inputs: array = dataclasses.field(default_factory=lambda: array('H'), init=False)
 
 
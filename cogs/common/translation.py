@@ -0,0 +1,639 @@
+import asyncio
+import collections
+from datetime import timedelta
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import re
+import sqlite3
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+import unicodedata
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+DEEPL_ENDPOINT = "https://api-free.deepl.com/v2/translate"
+PRIORITY_NEW = 0
+PRIORITY_EDIT = 1
+
+_MARKUP = re.compile(r"https?://\S+|<(?:@[!&]?|#|a?:\w+:)\d+>|:\w+:")
+_LINE_SEPARATOR = re.compile(r"(\n+)")
+_WORD = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+_ENGLISH_WORDS = frozenset((
+    "a", "about", "after", "again", "all", "am", "an", "and", "any", "are", "as", "at",
+    "be", "but", "by", "can", "could", "did", "do", "does", "for", "from", "gg", "glhf",
+    "game", "games", "good", "got", "had", "has", "have", "he", "hello", "her", "here", "hi",
+    "him", "his", "how", "i", "i'm", "if", "in", "ip", "is", "it", "it's", "just", "let's",
+    "lol", "me", "more", "my", "no", "not", "now", "of", "ok", "okay", "on", "one", "or",
+    "our", "out", "play", "please", "port", "she", "so", "some", "sorry", "thank", "thanks",
+    "that", "the", "their", "them", "then", "there", "they", "this", "to", "too", "up", "us",
+    "was", "we", "well", "were", "what", "when", "where", "which", "who", "why", "will",
+    "with", "would", "yes", "you", "your",
+))
+
+
+def detect_language(text: str) -> Optional[str]:
+    """
+    Guesses the language of the text from the Unicode blocks of its letters,
+    without a network round trip. Returns 'JA' (kana, with or without kanji),
+    'KO' or 'EN', or None when there are no letters, the scripts are mixed, or
+    the script alone cannot tell the language: Han without kana may be
+    Japanese or Chinese, and Latin text is only 'EN' when its words look
+    English. URLs, mentions and emoji are ignored.
+    """
+    text = _MARKUP.sub('', text)
+    kana = han = hangul = latin = 0
+    for c in text:
+        code = ord(c)
+        if 0x3040 <= code <= 0x30ff or 0xff66 <= code <= 0xff9f:
+            kana += 1
+        elif 0x4e00 <= code <= 0x9fff or 0x3400 <= code <= 0x4dbf:
+            han += 1
+        elif 0xac00 <= code <= 0xd7af or 0x1100 <= code <= 0x11ff or 0x3130 <= code <= 0x318f:
+            hangul += 1
+        elif c.isalpha() and code < 0x250 or 0xff21 <= code <= 0xff3a or 0xff41 <= code <= 0xff5a:
+            latin += 1
+
+    letters = kana + han + hangul + latin
+    if letters == 0:
+        return None
+    if latin >= letters * .9:
+        return 'EN' if _looks_english(text) else None
+    if hangul >= letters * .5:
+        return 'KO'
+    if kana + han >= letters * .5 and kana >= (kana + han) * .1:
+        return 'JA'
+    return None
+
+
+def _looks_english(text: str) -> bool:
+    # Short texts must be made of common English words only. Longer ones are
+    # English when enough of their words are, as in any English sentence.
+    # Letters outside ASCII (umlauts, accents) mean another language.
+    words = _WORD.findall(unicodedata.normalize('NFKC', text).lower())
+    if not words or any(not word.isascii() for word in words):
+        return False
+    known = sum(word.strip("'") in _ENGLISH_WORDS for word in words)
+    if len(words) < 4:
+        return known == len(words)
+    return known >= len(words) * .3
+
+
+def split_segments(text: str) -> List[str]:
+    """
+    Splits text into lines. Even indices hold the lines and odd indices the
+    line breaks between them, so ''.join() restores the text.
+    """
+    return _LINE_SEPARATOR.split(text)
+
+
+def is_translatable(segment: str) -> bool:
+    return any(c.isalnum() for c in segment)
+
+
+class DeeplError(Exception):
+    def __init__(self, status: int, message: str='') -> None:
+        super().__init__(f"DeepL API returned {status}: {message}")
+        self.status = status
+
+
+class DeeplClient:
+    """
+    Non-blocking DeepL client. Requests go through one aiohttp session whose
+    connector keeps connections alive between translations, and at most
+    max_concurrency of them are in flight at once.
+    """
+    def __init__(
+        self,
+        auth_key: str,
+        endpoint: str=DEEPL_ENDPOINT, *,
+        timeout: timedelta=timedelta(seconds=10),
+        max_concurrency: int=4,
+        keepalive: timedelta=timedelta(seconds=60),
+    ) -> None:
+        self.auth_key = auth_key
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.keepalive = keepalive
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.max_concurrency,
+                keepalive_timeout=self.keepalive.total_seconds())
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout.total_seconds()),
+                headers={'Authorization': f"DeepL-Auth-Key {self.auth_key}"})
+        return self._session
+
+    async def translate(self, text: Union[str, Sequence[str]], target_lang: str) -> Dict[str, Any]:
+        texts = [text] if isinstance(text, str) else text
+        params = [('text', t) for t in texts]
+        params.append(('target_lang', target_lang))
+        async with self._semaphore:
+            async with self._get_session().post(self.endpoint, data=params) as response:
+                if response.status != 200:
+                    raise DeeplError(response.status, await response.text())
+                return await response.json()
+
+    async def usage(self) -> Dict[str, Any]:
+        endpoint = self.endpoint.rsplit('/', 1)[0] + '/usage'
+        async with self._semaphore:
+            async with self._get_session().get(endpoint) as response:
+                if response.status != 200:
+                    raise DeeplError(response.status, await response.text())
+                return await response.json()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class TranslationShed(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self, tokens: float=1.) -> float:
+        """Takes the tokens and returns 0, or returns the seconds to wait for them."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.
+        return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: float=1.):
+        delay = self.reserve(tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.reserve(tokens)
+
+
+class TranslationQueue:
+    """
+    Priority queue in front of DeeplClient. Workers send requests in priority
+    order (new messages before edits) at the token bucket's rate, and refuse
+    requests that would exceed the character quota reported by /usage.
+    Requests refused with 429 or 5xx pause every worker with exponential
+    backoff and are retried. A 456 means the quota is used up until it resets,
+    so requests fail at once, without reaching DeepL, until /usage is checked
+    again usage_interval later. Once max_depth requests are waiting, the lowest
+    priority one is shed with TranslationShed.
+    """
+    RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+    QUOTA_EXCEEDED = 456
+
+    def __init__(
+        self,
+        client: DeeplClient, *,
+        rate: float=5.,
+        burst: float=10.,
+        max_depth: int=100,
+        workers: int=2,
+        retries: int=5,
+        backoff: timedelta=timedelta(seconds=1),
+        usage_interval: timedelta=timedelta(minutes=10),
+    ) -> None:
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.max_depth = max_depth
+        self._worker_count = workers
+        self._workers = []
+        self._retries = retries
+        self._backoff = backoff
+        self._heap = []
+        self._counter = itertools.count()
+        self._ready = asyncio.Event()
+        self._paused_until = 0.
+        self._usage_interval = usage_interval
+        self._usage_checked = None
+        self._exhausted_until = 0.
+        self.character_count = 0
+        self.character_limit = None
+        self.shed = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def headroom(self) -> Optional[int]:
+        if self.character_limit is None:
+            return None
+        return self.character_limit - self.character_count
+
+    async def translate(
+        self,
+        text: Union[str, Sequence[str]],
+        target_lang: str,
+        priority: int=PRIORITY_NEW
+    ) -> Dict[str, Any]:
+        if not self._workers:
+            self._workers = [
+                asyncio.ensure_future(self._work()) for _ in range(self._worker_count)]
+
+        texts = [text] if isinstance(text, str) else list(text)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._counter), texts, target_lang, future))
+        if len(self._heap) > self.max_depth:
+            self._shed()
+        self._ready.set()
+        return await future
+
+    def _shed(self):
+        worst = max(self._heap)
+        self._heap.remove(worst)
+        heapq.heapify(self._heap)
+        self.shed += 1
+        worst[-1].set_exception(TranslationShed("translation queue is full"))
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            while not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+            _, _, texts, target_lang, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            try:
+                response = await self._send(texts, target_lang)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(response)
+
+    async def _send(self, texts: List[str], target_lang: str) -> Dict[str, Any]:
+        characters = sum(map(len, texts))
+        await self._refresh_usage()
+        if time.monotonic() < self._exhausted_until:
+            raise DeeplError(self.QUOTA_EXCEEDED, "character quota is used up")
+        headroom = self.headroom()
+        if headroom is not None and characters > headroom:
+            raise DeeplError(self.QUOTA_EXCEEDED, "character quota would be exceeded")
+
+        for attempt in range(self._retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+            try:
+                response = await self.client.translate(texts, target_lang)
+            except DeeplError as e:
+                if e.status == self.QUOTA_EXCEEDED:
+                    self._exhaust()
+                    raise
+                if e.status not in self.RETRY_STATUSES or attempt == self._retries:
+                    raise
+                delay = self._backoff.total_seconds() * 2 ** attempt
+                logger.warning(f"DeepL returned {e.status}, retrying in {delay}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                continue
+            self.character_count += characters
+            return response
+
+    async def _refresh_usage(self):
+        now = time.monotonic()
+        if (self._usage_checked is not None
+                and now - self._usage_checked < self._usage_interval.total_seconds()):
+            return
+        self._usage_checked = now
+        try:
+            usage = await self.client.usage()
+        except Exception:
+            logger.exception("failed to fetch DeepL usage")
+            return
+        self.character_count = usage['character_count']
+        self.character_limit = usage['character_limit']
+
+    def _exhaust(self):
+        # Wait for the next /usage check, when the quota may have been reset.
+        logger.warning("DeepL character quota is used up")
+        now = time.monotonic()
+        self._usage_checked = now
+        self._exhausted_until = now + self._usage_interval.total_seconds()
+        if self.character_limit is not None:
+            self.character_count = max(self.character_count, self.character_limit)
+
+
+class TranslationBatcher:
+    """
+    Collects the texts sent to the same target language with the same priority
+    for up to window, or until max_batch texts or max_bytes of form-encoded
+    text are waiting, and translates them with one request. DeepL refuses
+    requests larger than 128 KiB.
+    Each caller gets back its own translation, or the error of the request.
+    """
+    def __init__(
+        self,
+        queue: TranslationQueue, *,
+        window: timedelta=timedelta(milliseconds=50),
+        max_batch: int=50,
+        max_bytes: int=120 * 1024,
+    ) -> None:
+        self.queue = queue
+        self.window = window
+        self.max_batch = max_batch
+        self.max_bytes = max_bytes
+        self._pending = {}
+        self._sizes = {}
+        self._timers = {}
+        self._tasks = set()
+        self.requests = 0
+        self.texts = 0
+
+    @staticmethod
+    def encoded_size(text: str) -> int:
+        return len(urllib.parse.quote_plus(text)) + len("&text=")
+
+    async def translate(self, text: str, target_lang: str, priority: int=PRIORITY_NEW) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (target_lang, priority)
+        size = self.encoded_size(text)
+        if key in self._pending and self._sizes[key] + size > self.max_bytes:
+            self.flush(key)
+        batch = self._pending.setdefault(key, [])
+        batch.append((text, future))
+        self._sizes[key] = self._sizes.get(key, 0) + size
+        if len(batch) >= self.max_batch or self._sizes[key] >= self.max_bytes:
+            self.flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window.total_seconds(), self.flush, key)
+        return await future
+
+    def flush(self, key: Tuple[str, int]):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._sizes.pop(key, None)
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._send(batch, *key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]], target_lang: str, priority: int):
+        self.requests += 1
+        self.texts += len(batch)
+        try:
+            json_response = await self.queue.translate(
+                [text for text, _ in batch], target_lang, priority)
+            translations = json_response["translations"]
+            if len(translations) != len(batch):
+                raise DeeplError(200, f"{len(translations)} translations for {len(batch)} texts")
+            for (_, future), translation in zip(batch, translations):
+                if not future.done():
+                    future.set_result(translation["text"])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class _WriteBehind:
+    """
+    Buffers the writes to an sqlite table and applies them with one commit
+    once max_pending keys are waiting, or interval after the first one, so
+    that the event loop does not wait on a commit for every write. A later
+    write to the same key replaces the buffered one and moves it to the end.
+    """
+    def __init__(
+        self,
+        db: sqlite3.Connection,
+        apply, *,
+        max_pending: int=64,
+        interval: timedelta=timedelta(seconds=2),
+    ) -> None:
+        self._db = db
+        self._apply = apply
+        self.max_pending = max_pending
+        self.interval = interval
+        self.pending = {}
+        self._timer = None
+
+    def __setitem__(self, key, value):
+        self.pending.pop(key, None)
+        self.pending[key] = value
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+        elif self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._timer = loop.call_later(self.interval.total_seconds(), self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self._apply(pending)
+        self._db.commit()
+
+
+class TranslationCache:
+    """
+    Content-addressed cache of translations keyed by (text without surrounding
+    whitespace, target language). Lookups hit an in-memory LRU first and then
+    an sqlite table, which keeps translations across restarts. Writes to the
+    table are batched, and it is trimmed back to the disk_capacity most
+    recently used translations. path=None keeps only the memory tier.
+    """
+    def __init__(
+        self,
+        path: Optional[str]=None,
+        capacity: int=1024,
+        disk_capacity: int=100000,
+    ) -> None:
+        self.capacity = capacity
+        self.disk_capacity = disk_capacity
+        self._memory = collections.OrderedDict()
+        self._db = None
+        self._writes = None
+        self._rows = 0
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations "
+                "(digest TEXT, target_lang TEXT, translated TEXT, PRIMARY KEY (digest, target_lang))")
+            self._db.commit()
+            self._rows = self._db.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+            self._writes = _WriteBehind(self._db, self._write)
+        self.hits = 0
+        self.misses = 0
+        self.saved_chars = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.strip()
+
+    @classmethod
+    def key(cls, text: str, target_lang: str) -> Tuple[str, str]:
+        digest = hashlib.sha256(cls.normalize(text).encode()).hexdigest()
+        return digest, target_lang.upper()
+
+    def get(self, text: str, target_lang: str) -> Optional[str]:
+        key = self.key(text, target_lang)
+        translated = self._memory.get(key)
+        if translated is not None:
+            self._memory.move_to_end(key)
+        elif self._db is not None:
+            translated = self._writes.pending.get(key)
+            if translated is None:
+                row = self._db.execute(
+                    "SELECT translated FROM translations WHERE digest = ? AND target_lang = ?",
+                    key).fetchone()
+                if row is not None:
+                    translated = row[0]
+                    # Write the row again, so that it is trimmed last.
+                    self._writes[key] = translated
+            if translated is not None:
+                self._remember(key, translated)
+
+        if translated is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.saved_chars += len(text)
+        return translated
+
+    def put(self, text: str, target_lang: str, translated: str):
+        key = self.key(text, target_lang)
+        self._remember(key, translated)
+        if self._db is not None:
+            self._writes[key] = translated
+
+    def _remember(self, key: Tuple[str, str], translated: str):
+        self._memory[key] = translated
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def _write(self, pending: Dict[Tuple[str, str], str]):
+        # A replaced row gets a new rowid, so rowid order is the order of use.
+        self._db.executemany(
+            "INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+            ((*key, translated) for key, translated in pending.items()))
+        self._rows += len(pending)
+        # Trim with some slack, so that a full table is not scanned on every flush.
+        if self._rows > self.disk_capacity + self.disk_capacity // 10:
+            self._db.execute(
+                "DELETE FROM translations WHERE rowid NOT IN "
+                "(SELECT rowid FROM translations ORDER BY rowid DESC LIMIT ?)",
+                (self.disk_capacity,))
+            self._rows = self._db.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def close(self):
+        if self._db is not None:
+            self._writes.flush()
+            self._db.close()
+            self._db = None
+
+
+class MessageMap:
+    """
+    Bounded map from an original message id to its translated posts (any
+    JSON-serializable value), kept in insertion order so that the oldest entry
+    is evicted in O(1). With a path, entries are mirrored to sqlite and the
+    newest capacity entries are loaded back on start, so edits and deletions
+    still find their counterpart after a restart. Writes to sqlite are
+    batched.
+    """
+    def __init__(self, path: Optional[str]=None, capacity: int=10000) -> None:
+        self.capacity = capacity
+        self._ids = collections.OrderedDict()
+        self._db = None
+        self._writes = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS message_map "
+                "(origin INTEGER PRIMARY KEY, mirrored TEXT)")
+            rows = self._db.execute(
+                "SELECT origin, mirrored FROM message_map ORDER BY rowid DESC LIMIT ?",
+                (capacity,)).fetchall()
+            self._ids.update((origin, json.loads(mirrored)) for origin, mirrored in reversed(rows))
+            self._db.execute(
+                "DELETE FROM message_map WHERE rowid NOT IN "
+                "(SELECT rowid FROM message_map ORDER BY rowid DESC LIMIT ?)",
+                (capacity,))
+            self._db.commit()
+            self._writes = _WriteBehind(self._db, self._write)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, origin: int) -> bool:
+        return origin in self._ids
+
+    def __setitem__(self, origin: int, mirrored: Any):
+        self._ids[origin] = mirrored
+        self._ids.move_to_end(origin)
+        evicted = None
+        if len(self._ids) > self.capacity:
+            evicted, _ = self._ids.popitem(last=False)
+        if self._db is not None:
+            if evicted is not None:
+                self._writes[evicted] = None
+            self._writes[origin] = json.dumps(mirrored)
+
+    def get(self, origin: int) -> Any:
+        return self._ids.get(origin)
+
+    def pop(self, origin: int) -> Any:
+        mirrored = self._ids.pop(origin, None)
+        if mirrored is not None and self._db is not None:
+            self._writes[origin] = None
+        return mirrored
+
+    def _write(self, pending: Dict[int, Optional[str]]):
+        self._db.executemany(
+            "DELETE FROM message_map WHERE origin = ?",
+            ((origin,) for origin, mirrored in pending.items() if mirrored is None))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO message_map VALUES (?, ?)",
+            ((origin, mirrored) for origin, mirrored in pending.items() if mirrored is not None))
+
+    def close(self):
+        if self._db is not None:
+            self._writes.flush()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,119 @@
+import asyncio
+import socket
+from typing import Any, Callable, Tuple
+
+
+class BufferedDatagramTransport(asyncio.DatagramTransport):
+    """
+    Datagram transport that drains its socket with recvfrom_into on each
+    readiness callback, reading up to batch_size datagrams into a pool of
+    preallocated buffers. The protocol receives memoryviews into that pool,
+    which are only valid until the next readiness callback.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        sock: socket.socket,
+        protocol: asyncio.DatagramProtocol, *,
+        batch_size: int=16,
+        buffer_size: int=2048,
+        waiter: asyncio.Future=None,
+    ) -> None:
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._views = [memoryview(bytearray(buffer_size)) for _ in range(batch_size)]
+        self._closing = False
+
+        self._extra = {'socket': sock, 'sockname': sock.getsockname()}
+        try:
+            self._extra['peername'] = sock.getpeername()
+        except OSError:
+            self._extra['peername'] = None
+
+        loop.add_reader(sock.fileno(), self._read_ready)
+        loop.call_soon(protocol.connection_made, self)
+        if waiter is not None:
+            loop.call_soon(waiter.set_result, None)
+
+    def _read_ready(self):
+        recvfrom_into = self._sock.recvfrom_into
+        datagram_received = self._protocol.datagram_received
+        for view in self._views:
+            try:
+                nbytes, addr = recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._protocol.error_received(exc)
+                return
+            datagram_received(view[:nbytes], addr)
+
+    def sendto(self, data: Any, addr: Tuple[str, int]=None):
+        if self._closing:
+            return
+        try:
+            if addr is None:
+                self._sock.send(data)
+            else:
+                self._sock.sendto(data, addr)
+        except OSError as exc:
+            self._protocol.error_received(exc)
+
+    def get_extra_info(self, name: str, default: Any=None) -> Any:
+        return self._extra.get(name, default)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def _call_connection_lost(self, exc: Exception):
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+
+
+async def create_datagram_endpoint(
+    loop: asyncio.AbstractEventLoop,
+    protocol_factory: Callable[[], asyncio.DatagramProtocol], *,
+    local_addr: Tuple[str, int]=None,
+    remote_addr: Tuple[str, int]=None,
+    batch_size: int=16,
+    buffer_size: int=2048,
+) -> Tuple[asyncio.DatagramTransport, asyncio.DatagramProtocol]:
+    """
+    Same as loop.create_datagram_endpoint, but receives through a
+    BufferedDatagramTransport. Falls back to the loop's own transport on event
+    loops without add_reader support.
+    """
+    protocol = protocol_factory()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    waiter = loop.create_future()
+    try:
+        sock.setblocking(False)
+        sock.bind(local_addr or ('0.0.0.0', 0))
+        if remote_addr is not None:
+            sock.connect(remote_addr)
+        transport = BufferedDatagramTransport(
+            loop, sock, protocol,
+            batch_size=batch_size, buffer_size=buffer_size, waiter=waiter)
+    except NotImplementedError:
+        sock.close()
+        return await loop.create_datagram_endpoint(
+            lambda: protocol, local_addr=local_addr, remote_addr=remote_addr)
+    except BaseException:
+        sock.close()
+        raise
+    await waiter
+    return transport, protocol
@@ -1,63 +1,323 @@
 from .cogmixin import CogMixin
+from .common import checks
+from .common.translation import (DeeplClient, MessageMap, TranslationBatcher, TranslationCache,
+                                 TranslationQueue, PRIORITY_NEW, PRIORITY_EDIT,
+                                 detect_language, is_translatable, split_segments)
 from discord.ext import commands
 import discord
-import requests
+import asyncio
+from datetime import timedelta
+import json
 import os
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-DEEPL_ENDPOINT = "https://api-free.deepl.com/v2/translate"
 AUTH_KEY = os.environ['DEEPL_TOKEN']
+CACHE_PATH = os.environ.get('DEEPL_CACHE', "deepl_cache.sqlite3")
+MESSAGE_MAP_SIZE = int(os.environ.get('DEEPL_MESSAGE_MAP_SIZE', 10000))
 
+# Each group maps a channel name to the language posted in it. A message in
+# one channel of a group is translated into every other channel of the group.
+# DEEPL_CHANNEL_GROUPS holds them as a JSON list, e.g.
+# [{"jp-en": "JA", "en-jp": "EN", "zh-jp": "ZH"}].
+DEFAULT_CHANNEL_GROUPS = '[{"jp-en": "JA", "en-jp": "EN"}]'
 
-def translate(text, target_lang):
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded; utf-8'
-    }
-    params = {
-        'auth_key': AUTH_KEY,
-        'text': text,
-        'target_lang': target_lang,
-    }
-    response = requests.post(DEEPL_ENDPOINT,
-                             data=params,
-                             headers=headers)
-    if response.status_code != 200:
-        raise Exception
-    return response.json()
+# Notices posted back to the source channel, by the language of that channel.
+FAILED_MESSAGES = {
+    "JA": "翻訳に失敗しました。APILimitかもしれません",
+    "EN": "Translation failed. May be API limit",
+}
+TOO_LONG_MESSAGES = {
+    "JA": "翻訳後の文字数が2000を超えました。分割して投稿してください。",
+    "EN": "The number of characters after translation has exceeded 2000. Please split it up and post it.",
+}
+
+
+def load_channel_groups(config=None):
+    """Parses the channel groups from DEEPL_CHANNEL_GROUPS, or the given JSON."""
+    if config is None:
+        config = os.environ.get('DEEPL_CHANNEL_GROUPS', DEFAULT_CHANNEL_GROUPS)
+    groups = json.loads(config)
+    if (not isinstance(groups, list)
+            or not all(isinstance(group, dict) for group in groups)
+            or not all(isinstance(name, str) and isinstance(lang, str)
+                       for group in groups for name, lang in group.items())):
+        raise ValueError("DEEPL_CHANNEL_GROUPS must be a list of {channel name: language} objects")
+    return [{name: lang.upper() for name, lang in group.items()} for group in groups]
+
+
+class _Lane:
+    __slots__ = ('semaphore', 'next_ticket', 'next_commit', 'waiters', 'skipped')
+
+    def __init__(self, max_in_flight):
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.next_ticket = 0
+        self.next_commit = 0
+        self.waiters = {}
+        self.skipped = set()
+
+
+class DeliverySequencer:
+    """
+    Commits webhook posts and edits to each destination channel in the order
+    their tickets were reserved, while the translations before them run
+    concurrently. At most max_in_flight tickets are outstanding per destination,
+    and reserve() waits for a free slot. Deliveries refused with 429 are retried
+    with exponential backoff.
+    """
+    def __init__(
+        self, *,
+        max_in_flight: int=8,
+        retries: int=3,
+        backoff: timedelta=timedelta(seconds=1)
+    ) -> None:
+        self._max_in_flight = max_in_flight
+        self._retries = retries
+        self._backoff = backoff
+        self._lanes = {}
+
+    def __len__(self):
+        return sum(lane.next_ticket - lane.next_commit for lane in self._lanes.values())
+
+    async def reserve(self, destination):
+        lane = self._lanes.get(destination)
+        if lane is None:
+            lane = self._lanes[destination] = _Lane(self._max_in_flight)
+        await lane.semaphore.acquire()
+        ticket = lane.next_ticket
+        lane.next_ticket += 1
+        return ticket
+
+    async def commit(self, destination, ticket, deliver):
+        """Waits for the earlier tickets of the destination, then awaits deliver()."""
+        lane = self._lanes[destination]
+        if ticket != lane.next_commit:
+            future = asyncio.get_running_loop().create_future()
+            lane.waiters[ticket] = future
+            try:
+                await future
+            except asyncio.CancelledError:
+                self.skip(destination, ticket)
+                raise
+        try:
+            return await self._deliver(deliver)
+        finally:
+            self._advance(lane)
+
+    def skip(self, destination, ticket):
+        """Gives up the ticket without delivering anything."""
+        lane = self._lanes[destination]
+        lane.waiters.pop(ticket, None)
+        if ticket == lane.next_commit:
+            self._advance(lane)
+        else:
+            lane.skipped.add(ticket)
+
+    def _advance(self, lane):
+        lane.next_commit += 1
+        lane.semaphore.release()
+        while lane.next_commit in lane.skipped:
+            lane.skipped.remove(lane.next_commit)
+            lane.next_commit += 1
+            lane.semaphore.release()
+        future = lane.waiters.pop(lane.next_commit, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def _deliver(self, deliver):
+        for attempt in range(self._retries + 1):
+            try:
+                return await deliver()
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == self._retries:
+                    raise
+                await asyncio.sleep(self._backoff.total_seconds() * 2 ** attempt)
 
 
 class Deepl(CogMixin, commands.Cog):
-    def __init__(self, bot):
+    def __init__(self, bot, channel_groups=None):
         self.bot = bot
-        self.jp_en_ch = None
-        self.en_jp_ch = None
-        self.send_ids = {}
-
-    @commands.Cog.listener(name='on_ready')
-    async def get_channel(self):
-        if self.jp_en_ch is None:
-            self.jp_en_ch = discord.utils.get(self.bot.get_all_channels(), name="jp-en")
-            self.jp_en_hook = (await self.jp_en_ch.webhooks())[0]
-        if self.en_jp_ch is None:
-            self.en_jp_ch = discord.utils.get(self.bot.get_all_channels(), name="en-jp")
-            self.en_jp_hook = (await self.en_jp_ch.webhooks())[0]
+        if channel_groups is None:
+            channel_groups = load_channel_groups()
+        self.groups = {name: group for group in channel_groups for name in group}
+        self.client = DeeplClient(AUTH_KEY)
+        self.queue = TranslationQueue(self.client)
+        self.batcher = TranslationBatcher(self.queue)
+        self.cache = TranslationCache(CACHE_PATH)
+        self.send_ids = MessageMap(CACHE_PATH, MESSAGE_MAP_SIZE)
+        self.sequencer = DeliverySequencer()
+        self.passed_chars = 0
+
+    def cog_unload(self):
+        self.queue.close()
+        asyncio.ensure_future(self.client.close())
+        self.cache.close()
+        self.send_ids.close()
+
+    async def get_hook(self, name):
+        return await self.bot.channel_registry.webhook(name)
+
+    async def translate_text(self, text, target_lang, priority=PRIORITY_NEW):
+        translated_text = self.cache.get(text, target_lang)
+        if translated_text is None:
+            translated_text = await self.batcher.translate(text, target_lang, priority)
+            self.cache.put(text, target_lang, translated_text)
+        return translated_text
+
+    async def translate_lines(self, text, target_lang, priority=PRIORITY_NEW, previous=None):
+        """
+        Translates the text and returns it along with the translation of each
+        of its lines. Lines found in previous, the line translations of the
+        message before an edit, are reused, and lines already written in the
+        target language are passed through untouched. The other lines are sent
+        together as one text, so a new message is translated as a whole. If
+        DeepL does not keep the line breaks, each line is translated on its own.
+        """
+        previous = previous or {}
+        parts = split_segments(text)
+        target = target_lang.split('-')[0].upper()
+        translations = {}
+        pending = []
+        for i in range(0, len(parts), 2):
+            line = parts[i]
+            if not is_translatable(line) or line in translations or line in pending:
+                continue
+            if line in previous:
+                translations[line] = previous[line]
+            elif detect_language(line) == target:
+                self.passed_chars += len(line)
+            else:
+                pending.append(line)
+
+        if pending:
+            translated_text = await self.translate_text('\n'.join(pending), target_lang, priority)
+            translated_lines = translated_text.split('\n')
+            if len(translated_lines) != len(pending):
+                translated_lines = await asyncio.gather(
+                    *(self.translate_text(line, target_lang, priority) for line in pending))
+            translations.update(zip(pending, translated_lines))
+
+        for i in range(0, len(parts), 2):
+            parts[i] = translations.get(parts[i], parts[i])
+        return ''.join(parts), translations
+
+    @checks.is_manager()
+    @commands.command()
+    async def deeplstat(self, ctx):
+        """
+        翻訳キャッシュ、翻訳不要と判定した文字数、バッチ送信、送信待ちキュー、投稿待ちとAPI文字数枠の状況を表示します。
+        """
+        batch_size = self.batcher.texts / self.batcher.requests if self.batcher.requests else 0
+        headroom = self.queue.headroom()
+        await ctx.send(f"キャッシュヒット率: {self.cache.hit_rate():.1%}, "
+                       f"節約した文字数: {self.cache.saved_chars}, "
+                       f"翻訳不要: {self.passed_chars}文字, "
+                       f"平均バッチサイズ: {batch_size:.1f}\n"
+                       f"送信待ち: {len(self.queue)}, 破棄: {self.queue.shed}, "
+                       f"投稿待ち: {len(self.sequencer)}, "
+                       f"残り文字数: {'不明' if headroom is None else headroom}")
+
+    def source_lang(self, channel):
+        return self.groups[channel.name][channel.name]
+
+    def destinations(self, channel):
+        """Returns the (channel name, language) pairs a message in the channel is mirrored to."""
+        group = self.groups.get(getattr(channel, 'name', None))
+        if group is None:
+            return []
+        return [(name, lang) for name, lang in group.items()
+                if name != channel.name and self.bot.channel_registry.get(name) is not None]
+
+    async def mirror(self, message, priority=PRIORITY_NEW):
+        """
+        Translates the message into every destination of its channel concurrently
+        and posts each translation through the destination's webhook, or edits
+        the post made earlier for the same message. Tickets are reserved before
+        translating, so each destination receives posts in source order.
+        send_ids keeps, per destination, the id of the post and the translation
+        of each line, which an edit of the message reuses.
+        """
+        destinations = self.destinations(message.channel)
+        if not destinations:
+            return
+        tickets = [await self.sequencer.reserve(name) for name, _ in destinations]
+        mirrored = dict(self.send_ids.get(message.id) or {})
+        results = await asyncio.gather(
+            *(self.mirror_to(message, name, lang, priority, mirrored.get(name), ticket)
+              for (name, lang), ticket in zip(destinations, tickets)),
+            return_exceptions=True)
+
+        failed = False
+        for (name, _), result in zip(destinations, results):
+            if isinstance(result, Exception):
+                logger.error(f"failed to mirror {message.id} to {name}", exc_info=result)
+                failed = True
+            elif result is not None:
+                mirrored[name] = result
+        if mirrored:
+            self.send_ids[message.id] = mirrored
+        if failed:
+            notice = FAILED_MESSAGES.get(self.source_lang(message.channel), FAILED_MESSAGES["EN"])
+            await message.channel.send(notice)
+
+    async def mirror_to(self, message, name, lang, priority, mirrored, ticket):
+        mirrored_id = mirrored['id'] if mirrored else None
+        try:
+            translated_text, lines = await self.translate_lines(
+                message.content, lang, priority, mirrored['lines'] if mirrored else None)
+        except BaseException:
+            self.sequencer.skip(name, ticket)
+            raise
+        file_urls = [at.url for at in message.attachments]
+        if file_urls:
+            translated_text = 'file:' + ' '.join(file_urls) + '\n' + translated_text
+        if len(translated_text) > 2000:
+            self.sequencer.skip(name, ticket)
+            notice = TOO_LONG_MESSAGES.get(self.source_lang(message.channel), TOO_LONG_MESSAGES["EN"])
+            await message.channel.send(notice)
+            return None
+
+        user_name = message.author.name if message.author.nick is None else message.author.nick
+
+        async def deliver():
+            hook = await self.get_hook(name)
+            if mirrored_id is not None:
+                await hook.edit_message(mirrored_id,
+                                        content=translated_text,
+                                        username=user_name,
+                                        avatar_url=message.author.avatar_url)
+                return {'id': mirrored_id, 'lines': lines}
+            sended = await hook.send(content=translated_text,
+                                     wait=True,
+                                     username=user_name,
+                                     avatar_url=message.author.avatar_url)
+            return {'id': sended.id, 'lines': lines}
+
+        return await self.sequencer.commit(name, ticket, deliver)
 
     @commands.Cog.listener(name='on_message_delete')
     async def double_delete(self, message):
         if message.author.bot:
             return
-        origin_message_id = message.id
-        origin_message_channel = message.channel.name
-        webhook_message_id = self.send_ids[origin_message_id]
-        del self.send_ids[origin_message_id]
-        if origin_message_channel == "jp-en":
-            webhook_message = await self.en_jp_ch.fetch_message(webhook_message_id)
-        else:
-            webhook_message = await self.jp_en_ch.fetch_message(webhook_message_id)
-        await webhook_message.delete()
+        mirrored = self.send_ids.pop(message.id)
+        if not mirrored:
+            return
+
+        async def delete(name, webhook_message_id):
+            channel = self.bot.channel_registry.get(name)
+            if channel is None:
+                return
+            webhook_message = await channel.fetch_message(webhook_message_id)
+            await webhook_message.delete()
+
+        results = await asyncio.gather(
+            *(delete(name, post['id']) for name, post in mirrored.items()),
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"failed to delete a mirror of {message.id}", exc_info=result)
 
     @commands.Cog.listener(name='on_message_edit')
     async def re_translate(self, before, after):
@@ -65,86 +325,13 @@ class Deepl(CogMixin, commands.Cog):
             return
         if after.id not in self.send_ids:
             return
-
-        if after.channel == self.jp_en_ch:
-            try:
-                json_response = translate(after.content, "EN")
-            except Exception:
-                await self.jp_en_ch.send('APILimitかもしれません')
-                return
-            file_urls = [at.url for at in after.attachments]
-            translated_text = json_response["translations"][0]["text"]
-            if file_urls:
-                translated_text = 'file:' + ' '.join(file_urls) + '\n' + translated_text
-            if len(translated_text) > 2000:
-                self.jp_en_ch.send('翻訳後の文字数が2000を超えました。分割して投稿してください。')
-            user_name = after.author.name if after.author.nick is None else after.author.nick
-            await self.en_jp_hook.edit_message(self.send_ids[after.id],
-                                               content=translated_text,
-                                               username=user_name,
-                                               avatar_url=after.author.avatar_url)
-        elif after.channel == self.en_jp_ch:
-            try:
-                json_response = translate(after.content, 'JA')
-            except Exception:
-                await self.en_jp_ch.send('May be API limit')
-                return
-            file_urls = [at.url for at in after.attachments]
-            translated_text = json_response["translations"][0]["text"]
-            if file_urls:
-                translated_text = 'file:' + ' '.join(file_urls) + '\n' + translated_text
-            if len(translated_text) > 2000:
-                self.en_jp_ch.send('The number of characters after translation has exceeded 2000. Please split it up and post it.')
-            user_name = after.author.name if after.author.nick is None else after.author.nick
-            await self.jp_en_hook.edit_message(self.send_ids[after.id],
-                                               content=translated_text,
-                                               username=user_name,
-                                               avatar_url=after.author.avatar_url)
+        if (before.content == after.content
+                and [at.url for at in before.attachments] == [at.url for at in after.attachments]):
+            return
+        await self.mirror(after, PRIORITY_EDIT)
 
     @commands.Cog.listener(name='on_message')
     async def translate(self, message):
         if message.author.bot:
             return
-
-        if message.channel == self.jp_en_ch:
-            try:
-                json_response = translate(message.content, "EN")
-            except Exception:
-                await self.jp_en_ch.send('編集に失敗しました。APILimitかもしれません')
-                return
-            file_urls = [at.url for at in message.attachments]
-            translated_text = json_response["translations"][0]["text"]
-            if file_urls:
-                translated_text = 'file:' + ' '.join(file_urls) + '\n' + translated_text
-            if len(translated_text) > 2000:
-                self.en_jp_ch.send('The number of characters after translation has exceeded 2000. Please split it up and post it.')
-            user_name = message.author.name if message.author.nick is None else message.author.nick
-            sended = await self.en_jp_hook.send(content=translated_text,
-                                                wait=True,
-                                                username=user_name,
-                                                avatar_url=message.author.avatar_url)
-            self.send_ids[message.id] = sended.id
-            if len(self.send_ids) > 100:
-                min_id = min(self.send_ids.keys())
-                del self.send_ids[min_id]
-        elif message.channel == self.en_jp_ch:
-            try:
-                json_response = translate(message.content, 'JA')
-            except Exception:
-                await self.en_jp_ch.send('Edit failed. May be API limit')
-                return
-            file_urls = [at.url for at in message.attachments]
-            translated_text = json_response["translations"][0]["text"]
-            if file_urls:
-                translated_text = 'file:' + ' '.join(file_urls) + '\n' + translated_text
-            if len(translated_text) > 2000:
-                self.en_jp_ch.send('The number of characters after translation has exceeded 2000. Please split it up and post it.')
-            user_name = message.author.name if message.author.nick is None else message.author.nick
-            sended = await self.jp_en_hook.send(content=translated_text,
-                                                wait=True,
-                                                username=user_name,
-                                                avatar_url=message.author.avatar_url)
-            self.send_ids[message.id] = sended.id
-            if len(self.send_ids) > 100:
-                min_id = min(self.send_ids.keys())
-                del self.send_ids[min_id]
+        await self.mirror(message)
@@ -1,5 +1,5 @@
 from .cogmixin import CogMixin
-from .common import errors, checks, networks
+from .common import errors, checks, networks, udp
 
 from discord.ext import commands
 import discord
@@ -8,54 +8,20 @@ import unicodedata
 import asyncio
 
 import binascii
+import collections
 from datetime import (datetime, timedelta)
+import heapq
 import logging
+import random
+import time
 
 logger = logging.getLogger(__name__)
 
+REPLACED_MESSAGE = "以前の同じ種類の募集は取り下げて、新しい募集に置き換えました。"
 
-def get_hostlist_ch(bot):
-    return discord.utils.get(bot.get_all_channels(), name="募集リスト-hostlist")
-
-
-class HostStatus:
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.hosting = False
-        self.matching = False
-        self.watchable = False
-
-    def __call__(self, packet):
-        if packet.startswith(b'\x07\x01'):
-            self.hosting = True
-            self.matching = False
-            self.watchable = True
-        elif packet.startswith(b'\x07\x00'):
-            self.hosting = True
-            self.matching = False
-            self.watchable = False
-        elif packet.startswith(b'\x08\x01'):
-            self.hosting = True
-            self.matching = True
-            self.watchable = self.watchable
-        else:
-            self.reset()
-
-    def is_unknown(self):
-        return (
-            not self.hosting and
-            not self.matching and
-            not self.watchable)
 
-    def __str__(self):
-        if self.is_unknown():
-            return ":question:"
-
-        return " ".join([
-            ":crossed_swords:" if self.matching else ":o:",
-            ":eye:" if self.watchable else ":see_no_evil:"])
+def get_hostlist_ch(bot):
+    return bot.channel_registry.get('hostlist')
 
 
 class Th123DatagramProtocol(asyncio.DatagramProtocol):
@@ -66,6 +32,11 @@ class Th123DatagramProtocol(asyncio.DatagramProtocol):
     ) -> None:
         self.lifetime = lifetime
         self.ack_lifetime = ack_lifetime
+        self.ipport = None
+        self.on_change = None
+
+    def lifetimes(self):
+        return (self.lifetime,)
 
     def try_echo(self):
         pass
@@ -77,6 +48,7 @@ class Th123DatagramProtocol(asyncio.DatagramProtocol):
 class Th123HostProtocol(Th123DatagramProtocol):
     def __init__(
         self,
+        ipport: networks.IpPort,
         echo_packet: bytes, *,
         lifetime: networks.Lifetime=None,
         ack_lifetime: networks.Lifetime=None
@@ -84,37 +56,221 @@ class Th123HostProtocol(Th123DatagramProtocol):
         super().__init__(
             lifetime or networks.Lifetime(timedelta(seconds=20)),
             ack_lifetime or networks.Lifetime(timedelta(seconds=6)))
+        self.ipport = ipport
         self.echo_packet = echo_packet
 
         self.transport = None
-        self.host_status = HostStatus()
+        self.multiplexer = None
+        self.host_status = networks.HostStatus()
+        self.quality = networks.LinkQuality()
+
+    def lifetimes(self):
+        return (self.lifetime, self.ack_lifetime)
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
+        was_expired = self.ack_lifetime.is_expired()
+        status = self.host_status.astuple()
+        indicator = self.quality.indicator()
         self.ack_lifetime.reset()
         self.host_status(data)
 
+        if not self.host_status.is_unknown():
+            self.lifetime.reset()
+            self.quality.received()
+
+        if self.on_change and (
+            was_expired or
+            status != self.host_status.astuple() or
+            indicator != self.quality.indicator()
+        ):
+            self.on_change()
+
         if self.host_status.is_unknown():
-            logging_message = " ".join([str(addr), str(data)])
+            logging_message = " ".join([str(addr), str(bytes(data))])
             logger.error(logging_message)
-            return
-
-        self.lifetime.reset()
 
     def error_received(self, exc):
         pass
 
     def connection_lost(self, exc):
-        pass
+        self.transport = None
 
     def try_echo(self):
-        self.transport.sendto(self.echo_packet)
+        if self.transport:
+            # An unanswered probe counts as a loss, which can change the
+            # indicator even though no reply arrives.
+            indicator = self.quality.indicator()
+            self.quality.sent()
+            if self.on_change and indicator != self.quality.indicator():
+                self.on_change()
+            self.transport.sendto(self.echo_packet, tuple(self.ipport))
 
     def discard(self):
-        if self.transport and not self.transport.is_closing():
-            self.transport.close()
+        if self.multiplexer:
+            self.multiplexer.unregister(self)
+
+
+class ProbeScheduler:
+    """
+    Keeps a next-probe deadline per host protocol.
+    New hosts, and hosts that changed status since their last probe, are
+    probed every min_interval. Hosts that did not answer are probed every
+    silent_interval, like every host was before. Each answer with an unchanged
+    status doubles the interval up to max_interval, which stays well within
+    the 6 seconds ack lifetime. Every deadline is jittered so that probes do
+    not go out in bursts.
+    """
+    def __init__(
+        self, *,
+        min_interval: timedelta=timedelta(seconds=1),
+        silent_interval: timedelta=timedelta(seconds=2),
+        max_interval: timedelta=timedelta(seconds=3),
+        jitter: float=0.2,
+        rate_window: timedelta=timedelta(seconds=10)
+    ) -> None:
+        self._min_interval_ns = min_interval // timedelta(microseconds=1) * 1000
+        self._silent_interval_ns = silent_interval // timedelta(microseconds=1) * 1000
+        self._max_interval_ns = max_interval // timedelta(microseconds=1) * 1000
+        self._jitter = jitter
+        self._rate_window_ns = rate_window // timedelta(microseconds=1) * 1000
+
+        self._heap = []
+        self._states = {}
+        self._sequence = 0
+        self._sent = collections.deque()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._states)
+
+    def add(self, protocol):
+        self._states[protocol] = _ProbeState(protocol, self._min_interval_ns)
+        self._push(protocol, time.monotonic_ns())
+        self._wakeup.set()
+
+    def remove(self, protocol):
+        self._states.pop(protocol, None)
+
+    def probe_rate(self) -> float:
+        """Probes sent per second over the rate window."""
+        self._expire_sent(time.monotonic_ns())
+        return len(self._sent) * 1e9 / self._rate_window_ns
+
+    def _push(self, protocol, deadline):
+        self._sequence += 1
+        self._states[protocol].sequence = self._sequence
+        heapq.heappush(self._heap, (deadline, self._sequence, protocol))
+
+    def _expire_sent(self, now):
+        while self._sent and self._sent[0] <= now - self._rate_window_ns:
+            self._sent.popleft()
+
+    def _probe(self, protocol, state, now):
+        status = protocol.host_status.astuple()
+        answered = protocol.ack_lifetime.deadline != state.ack_deadline
+        if state.ack_deadline is None:
+            state.interval = self._min_interval_ns
+        elif not answered:
+            state.interval = self._silent_interval_ns
+        elif status == state.status:
+            state.interval = min(state.interval * 2, self._max_interval_ns)
+        else:
+            state.interval = self._min_interval_ns
+        state.status = status
+        state.ack_deadline = protocol.ack_lifetime.deadline
+
+        jitter = random.uniform(1 - self._jitter, 1 + self._jitter)
+        self._push(protocol, now + int(state.interval * jitter))
+        self._sent.append(now)
+        protocol.try_echo()
+
+    def run_pending(self) -> float:
+        """
+        Probes every host whose deadline has passed and returns the seconds
+        until the next deadline, or None when nothing is scheduled.
+        """
+        now = time.monotonic_ns()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, sequence, protocol = heapq.heappop(heap)
+            state = self._states.get(protocol)
+            if state is None or state.sequence != sequence:
+                continue
+            self._probe(protocol, state, now)
+        self._expire_sent(now)
+
+        if not heap:
+            return None
+        return (heap[0][0] - now) / 1e9
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = self.run_pending()
+            except Exception:
+                logger.exception("failed to probe hosts")
+                delay = self._min_interval_ns / 1e9
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+class _ProbeState:
+    __slots__ = ('interval', 'status', 'ack_deadline', 'sequence')
+
+    def __init__(self, protocol, interval):
+        self.interval = interval
+        self.status = protocol.host_status.astuple()
+        self.ack_deadline = None
+        self.sequence = 0
+
+
+class Th123HostMultiplexer(asyncio.DatagramProtocol):
+    """
+    Owns the one unconnected socket every host is probed from, routes each
+    reply to the protocol registered for its source address, and runs the
+    probe scheduler while the socket is open.
+    """
+    def __init__(self, scheduler: ProbeScheduler=None):
+        self.transport = None
+        self.scheduler = ProbeScheduler() if scheduler is None else scheduler
+        self._scheduler_task = None
+        self._protocols = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._scheduler_task = asyncio.ensure_future(self.scheduler.run())
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self._scheduler_task:
+            self._scheduler_task.cancel()
+
+    def register(self, protocol):
+        self._protocols[protocol.ipport] = protocol
+        protocol.multiplexer = self
+        protocol.connection_made(self.transport)
+        self.scheduler.add(protocol)
+
+    def unregister(self, protocol):
+        self.scheduler.remove(protocol)
+        if self._protocols.get(protocol.ipport) is protocol:
+            del self._protocols[protocol.ipport]
+        protocol.multiplexer = None
+        protocol.connection_lost(None)
+
+    def datagram_received(self, data, addr):
+        protocol = self._protocols.get(networks.IpPort.create(*addr))
+        if protocol is not None:
+            protocol.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        logger.error(exc)
 
 
 class Th123ClientProtocol(Th123DatagramProtocol):
@@ -125,57 +281,58 @@ class Th123ClientProtocol(Th123DatagramProtocol):
 
 
 class PostAsset:
+    __slots__ = ('user', 'message_body', 'protocol', 'terminates', 'start_datetime', '_rendered')
+
+    def __init__(self, user, message_body, protocol):
+        self.user = user
+        self.message_body = message_body
+        self.protocol = protocol
+        self.terminates = False
+        self._rendered = None
+
+        self.start_datetime = datetime.now()
+
     def get_message_body(self):
         raise NotImplementedError
 
+    def render(self):
+        if self._rendered is None:
+            self._rendered = self.get_message_body()
+        return self._rendered
+
+    def invalidate(self):
+        self._rendered = None
+
     def get_close_message(self):
         raise NotImplementedError
 
     def should_close(self):
-        raise NotImplementedError
+        return self.terminates or self.protocol.lifetime.is_expired()
 
     def terminate(self):
-        raise NotImplementedError
+        self.terminates = True
 
 
 class HostPostAsset(PostAsset):
-    def __init__(self, user, message_body, protocol):
-        self.user = user
-        self.message_body = message_body
-        self.protocol = protocol
-        self.terminates = False
-
-        self.start_datetime = datetime.now()
+    __slots__ = ()
 
     def get_message_body(self):
         if self.protocol.ack_lifetime.is_expired():
             return f":x: {self.message_body}"
 
-        return " ".join([
+        return " ".join(filter(None, [
             str(self.protocol.host_status),
-            self.message_body])
+            self.protocol.quality.indicator(),
+            self.message_body]))
 
     def get_close_message(self):
         if self.terminates:
             return str()
         return "一定時間ホストが検知されなかったため、募集を終了します。"
 
-    def should_close(self):
-        return self.terminates or self.protocol.lifetime.is_expired()
-
-    def terminate(self):
-        self.terminates = True
-        self.protocol.discard()
-
 
 class ClientPostAsset(PostAsset):
-    def __init__(self, user, message_body, protocol):
-        self.user = user
-        self.message_body = message_body
-        self.protocol = protocol
-        self.terminates = False
-
-        self.start_datetime = datetime.now()
+    __slots__ = ()
 
     def get_message_body(self):
         return " ".join([
@@ -187,17 +344,155 @@ class ClientPostAsset(PostAsset):
             return str()
         return "投稿から一定時間経過したため、募集を終了します。"
 
-    def should_close(self):
-        return self.terminates or self.protocol.lifetime.is_expired()
 
-    def terminate(self):
-        self.terminates = True
-        self.protocol.discard()
+class HostRegistry:
+    """
+    Live posts in posting order, indexed by user id and post type, and by
+    protocol. A user keeps at most one post of each type. Posts for the same
+    IpPort share one protocol, so the host is probed once.
+    """
+    def __init__(self):
+        self._posts = {}
+        self._by_user = {}
+        self._by_protocol = {}
+        self._protocols = {}
+
+    def __iter__(self):
+        return iter(self._posts)
+
+    def __len__(self):
+        return len(self._posts)
+
+    def __contains__(self, post):
+        return post in self._posts
+
+    def add(self, post):
+        """Adds the post and returns True if its protocol is new."""
+        self._posts[post] = None
+        self._by_user.setdefault(post.user.id, {})[type(post)] = post
+        posts = self._by_protocol.setdefault(post.protocol, {})
+        posts[post] = None
+        if post.protocol.ipport is not None:
+            self._protocols[post.protocol.ipport] = post.protocol
+        return len(posts) == 1
+
+    def remove(self, post):
+        """Removes the post and returns True if no post uses its protocol anymore."""
+        del self._posts[post]
+        user_posts = self._by_user.get(post.user.id, {})
+        if user_posts.get(type(post)) is post:
+            del user_posts[type(post)]
+            if not user_posts:
+                del self._by_user[post.user.id]
+        posts = self._by_protocol[post.protocol]
+        del posts[post]
+        if posts:
+            return False
+
+        del self._by_protocol[post.protocol]
+        if post.protocol.ipport is not None:
+            del self._protocols[post.protocol.ipport]
+        return True
+
+    def find_by_user(self, user, kind):
+        return self._by_user.get(user.id, {}).get(kind)
+
+    def posts_by_user(self, user):
+        return list(self._by_user.get(user.id, {}).values())
+
+    def find_protocol(self, ipport):
+        return self._protocols.get(ipport)
+
+    def posts_of(self, protocol):
+        return list(self._by_protocol.get(protocol, ()))
+
+
+class NotificationOutbox:
+    """
+    Bounded queue of direct messages delivered by background workers, so that
+    a slow or failing DM never holds up the caller. Failed sends are retried
+    with exponential backoff, users who do not accept DMs are skipped, and the
+    same message is not queued twice for a user while it is still pending.
+    """
+    def __init__(
+        self, *,
+        maxsize: int=256,
+        workers: int=2,
+        retries: int=3,
+        backoff: timedelta=timedelta(seconds=1)
+    ) -> None:
+        self._queue = asyncio.Queue(maxsize)
+        self._pending = set()
+        self._worker_count = workers
+        self._workers = []
+        self._retries = retries
+        self._backoff = backoff
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def send(self, user, content):
+        """Queues the message and returns False if it was dropped."""
+        if not self._workers:
+            self._workers = [
+                asyncio.ensure_future(self._work()) for _ in range(self._worker_count)]
+
+        key = (user.id, content)
+        if key in self._pending:
+            return False
+        try:
+            self._queue.put_nowait((user, content))
+        except asyncio.QueueFull:
+            logger.error(f"outbox is full, dropped a message to {user.id}")
+            return False
+        self._pending.add(key)
+        return True
+
+    async def join(self):
+        await self._queue.join()
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    async def _work(self):
+        while True:
+            user, content = await self._queue.get()
+            try:
+                await self._deliver(user, content)
+            except Exception:
+                # Keep the worker alive, or later messages would never be sent.
+                logger.exception(f"failed to send a message to {user.id}")
+            finally:
+                self._pending.discard((user.id, content))
+                self._queue.task_done()
+
+    async def _deliver(self, user, content):
+        for attempt in range(self._retries + 1):
+            try:
+                await user.send(content)
+                return
+            except discord.Forbidden:
+                logger.info(f"{user.id} does not accept direct messages")
+                return
+            except (discord.HTTPException, asyncio.TimeoutError, OSError):
+                if attempt == self._retries:
+                    logger.exception(f"failed to send a message to {user.id}")
+                    return
+                await asyncio.sleep(self._backoff.total_seconds() * 2 ** attempt)
 
 
 class HostListObserver:
     _bot = None
-    _host_list = []
+    _registry = HostRegistry()
+    _multiplexer = None
+    _multiplexer_lock = asyncio.Lock()
+    _closing = set()
+    _timer_wheel = networks.TimerWheel()
+    _changed = asyncio.Event()
+    _outbox = NotificationOutbox()
+    _base_message = "**{date}現在\n{num}人が対戦相手を募集しています:**\n"
 
     @classmethod
     async def task_func(cls, bot, interval=timedelta(seconds=2)):
@@ -215,67 +510,270 @@ class HostListObserver:
 "```!host 198.51.100.123:10800 霊夢 相互自由 どなたでもどうぞ```\n"
 "取り下げるにはサーバーを立てずに約20秒待つか、!closeコマンドを用います。\n"
 "「!client」コマンドはIP待ちやAutoPunch(いつか対応させます)を使った募集にご利用ください。\n"
-":o: 対戦可, :x: 不可, :crossed_swords: 対戦中, :eye: 観戦可, :see_no_evil:  観戦不可, :regional_indicator_r: sokuroll,  :loudspeaker: client")
+":o: 対戦可, :x: 不可, :crossed_swords: 対戦中, :eye: 観戦可, :see_no_evil:  観戦不可, :regional_indicator_r: sokuroll,  :loudspeaker: client\n"
+"`ms` Botからホストまでの応答時間, `lost` 応答の無かった検知の割合")
 
         await hostlist_ch.send(hostlist_info_message)
-        base_message = "**{date}現在\n{num}人が対戦相手を募集しています:**\n"
-        message = await hostlist_ch.send(base_message.format(date=datetime.now().strftime("%Y年%m月%d日T%H時%M分"), num=0))
-
-        while True:
-            host_list = cls._host_list[:]
-            for host in host_list:
-                host.protocol.try_echo()
+        message = await hostlist_ch.send(cls._base_message.format(date=datetime.now().strftime("%Y年%m月%d日T%H時%M分"), num=0))
 
-            await asyncio.sleep(interval.seconds)
+        await cls.get_multiplexer()
+        publisher = asyncio.ensure_future(cls.publish(hostlist_ch, [message]))
+        try:
+            while True:
+                await asyncio.sleep(interval.total_seconds())
+                cls.tick()
+        finally:
+            publisher.cancel()
 
-            message_body_list = list()
-            for host in host_list:
+    @classmethod
+    def tick(cls):
+        closing = cls._closing
+        cls._closing = set()
+        for protocol in cls._timer_wheel.advance():
+            for host in cls._registry.posts_of(protocol):
                 if host.should_close():
-                    await cls.close(host)
+                    closing.add(host)
+                else:
+                    cls.invalidate(host)
+        for host in closing:
+            cls.close(host)
+
+    @classmethod
+    def paginate(cls, pages, hosts, limit=2000):
+        """
+        Assigns the hostlist posts to pages that each fit in a single message.
+        The first page also carries the header, whose length is reserved.
+        A post keeps the page it was put on, so adding or removing a post
+        only changes its own page and the post count in the header. New posts,
+        and posts that grew out of their page, go to the tail page or a new
+        one. Emptied pages are left empty for the caller to drop, and the
+        posts are packed again only once their pages take more than twice the
+        messages a fresh packing would.
+        """
+        header_length = len(cls._base_message.format(
+            date=datetime.now().strftime("%Y年%m月%d日%H時%M分"),
+            num=len(hosts)))
+        alive = set(hosts)
+        placed = set()
+        assigned = []
+        lengths = []
+        for i, page in enumerate(pages or [[]]):
+            length = header_length if i == 0 else 0
+            kept = []
+            for host in page:
+                if host not in alive:
                     continue
+                body_length = min(len(host.render()), limit)
+                separator = 1 if kept else 0
+                if length + separator + body_length > limit:
+                    continue
+                length += separator + body_length
+                kept.append(host)
+                placed.add(host)
+            assigned.append(kept)
+            lengths.append(length)
+
+        for host in hosts:
+            if host in placed:
+                continue
+            body_length = min(len(host.render()), limit)
+            separator = 1 if assigned[-1] else 0
+            if lengths[-1] + separator + body_length > limit:
+                assigned.append([])
+                lengths.append(0)
+                separator = 0
+            lengths[-1] += separator + body_length
+            assigned[-1].append(host)
+
+        if pages:
+            used = 1 + sum(1 for page in assigned[1:] if page)
+            packed = cls.paginate(None, hosts, limit)
+            if used > 2 * len(packed):
+                return packed
+        return assigned
 
-                message_body_list.append(host.get_message_body())
+    @classmethod
+    async def publish(
+        cls, hostlist_ch, messages, *,
+        debounce: timedelta=timedelta(seconds=1),
+        backoff: timedelta=timedelta(seconds=2),
+        max_backoff: timedelta=timedelta(minutes=1)
+    ):
+        """
+        Keeps the hostlist messages up to date. A deleted message is posted
+        again, and other failures are retried with exponential backoff.
+        """
+        published = [None] * len(messages)
+        pages = [[]]
+        failures = 0
+        while True:
+            await cls._changed.wait()
+            await asyncio.sleep(debounce.total_seconds())
+            cls._changed.clear()
+
+            hosts = list(cls._registry)
+            pages = cls.paginate(pages, hosts)
+
+            try:
+                # Drop the messages of emptied pages; the first one keeps the header.
+                for i in reversed(range(1, len(pages))):
+                    if pages[i]:
+                        continue
+                    if i < len(messages):
+                        await cls._delete_message(messages[i])
+                        del messages[i]
+                        del published[i]
+                    del pages[i]
+
+                for i, page in enumerate(pages):
+                    body_list = [host.render() for host in page]
+                    # The header of the first page counts the posts.
+                    key = (len(hosts), body_list) if i == 0 else body_list
+                    if i < len(published) and key == published[i]:
+                        continue
+
+                    content = "\n".join(body[:2000] for body in body_list)
+                    if i == 0:
+                        content = cls._base_message.format(
+                            date=datetime.now().strftime("%Y年%m月%d日%H時%M分"), num=len(hosts)) + content
+
+                    if i < len(messages):
+                        published[i] = None
+                        try:
+                            await messages[i].edit(content=content)
+                        except discord.NotFound:
+                            # The message was deleted. Post this page and the
+                            # ones after it again, so the pages stay in order.
+                            while len(messages) > i:
+                                await cls._delete_message(messages.pop())
+                                published.pop()
+                        else:
+                            published[i] = key
+                            continue
+                    messages.append(await hostlist_ch.send(content))
+                    published.append(key)
+
+                while len(messages) > len(pages):
+                    await cls._delete_message(messages[-1])
+                    messages.pop()
+                    published.pop()
+                failures = 0
+            except discord.HTTPException:
+                logger.exception("failed to update the hostlist")
+                failures += 1
+                delay = min(backoff * 2 ** (failures - 1), max_backoff)
+                await asyncio.sleep(delay.total_seconds())
+                cls._changed.set()
+
+    @staticmethod
+    async def _delete_message(message):
+        try:
+            await message.delete()
+        except discord.NotFound:
+            pass
+
+    @classmethod
+    def invalidate(cls, host):
+        host.invalidate()
+        cls._changed.set()
 
-            post_message = (
-                base_message.format(date=datetime.now().strftime("%Y年%m月%d日%H時%M分") ,num=len(message_body_list)) +
-                "\n".join(message_body_list))
-            await message.edit(content=post_message)
+    @classmethod
+    def _invalidate_protocol(cls, protocol):
+        for host in cls._registry.posts_of(protocol):
+            host.invalidate()
+        cls._changed.set()
 
     @classmethod
-    async def close(cls, host):
+    async def get_multiplexer(cls):
+        async with cls._multiplexer_lock:
+            if cls._multiplexer is None:
+                _, cls._multiplexer = await udp.create_datagram_endpoint(
+                    asyncio.get_event_loop(), Th123HostMultiplexer, batch_size=64)
+        return cls._multiplexer
+
+    @classmethod
+    def shutdown(cls):
+        if cls._multiplexer is not None and cls._multiplexer.transport is not None:
+            cls._multiplexer.transport.close()
+        cls._multiplexer = None
+        cls._outbox.close()
+
+    @classmethod
+    def close(cls, host):
+        if host not in cls._registry:
+            return
+
         close_message = host.get_close_message()
         if close_message:
-            await host.user.send(close_message)
+            cls._outbox.send(host.user, close_message)
 
         cls._remove(host)
         host.terminate()
 
     @classmethod
     async def append(cls, host):
-        cls._host_list.append(host)
-        message = await get_hostlist_ch(cls._bot).send(".")
-        await message.delete()
+        """Adds the post and returns the earlier post of the same type it replaces, if any."""
+        previous = cls._registry.find_by_user(host.user, type(host))
+        if previous is not None:
+            previous.terminate()
+            cls._remove(previous)
+
+        protocol = host.protocol
+        if cls._registry.add(host):
+            if protocol.ipport is not None:
+                (await cls.get_multiplexer()).register(protocol)
+            for lifetime in protocol.lifetimes():
+                cls._timer_wheel.schedule(lifetime, protocol)
+            protocol.on_change = lambda: cls._invalidate_protocol(protocol)
+        cls._changed.set()
+        return previous
+
+    @classmethod
+    def find_protocol(cls, ipport):
+        return cls._registry.find_protocol(ipport)
+
+    @classmethod
+    def posts_of(cls, protocol):
+        return cls._registry.posts_of(protocol)
 
     @classmethod
     def terminate(cls, *, user):
-        target_posts = [host for host in cls._host_list if host.user == user]
-        for post in target_posts:
+        for post in cls._registry.posts_by_user(user):
             post.terminate()
+            cls._closing.add(post)
 
     @classmethod
     def _remove(cls, host):
-        cls._host_list.remove(host)
+        protocol = host.protocol
+        if cls._registry.remove(host):
+            for lifetime in protocol.lifetimes():
+                cls._timer_wheel.cancel(lifetime)
+            protocol.on_change = None
+            protocol.discard()
+        cls._changed.set()
 
 
 class Hosting(CogMixin, commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.first_ready = False
+        self.observer_task = None
+
+    def cog_unload(self):
+        if self.observer_task is not None:
+            self.observer_task.cancel()
+        HostListObserver.shutdown()
+
+    @staticmethod
+    def _on_observer_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("hostlist observer stopped", exc_info=task.exception())
 
     @commands.Cog.listener()
     async def on_ready(self):
         if not self.first_ready:
-            asyncio.ensure_future(HostListObserver.task_func(self.bot))
+            self.observer_task = asyncio.ensure_future(HostListObserver.task_func(self.bot))
+            self.observer_task.add_done_callback(self._on_observer_done)
             await super().on_ready()
             self.first_ready = True
 
@@ -311,14 +809,21 @@ class Hosting(CogMixin, commands.Cog):
             ":regional_indicator_r:" if sokuroll_uses else "",
             f"{user.mention}, {ipport} | {' '.join(comment)}"]).strip()
 
+        echo_packet = networks.Th123Packet.packet_05(sokuroll_uses=sokuroll_uses)
+        protocol = HostListObserver.find_protocol(ipport)
+        if protocol is not None and protocol.echo_packet != echo_packet:
+            # Replies are routed by address, so one IpPort is probed with one packet.
+            # Only the user's own post, which this one replaces, may use the other one.
+            if any(post.user.id != user.id for post in HostListObserver.posts_of(protocol)):
+                await ctx.send("このIP:Portは既に別の形式(!host/!rhost)で募集されています。")
+                return
+            protocol = None
+
         await ctx.send("ホストの検知を開始します。")
-        connect = self.bot.loop.create_datagram_endpoint(
-            lambda: Th123HostProtocol(
-                networks.Th123Packet.packet_05(sokuroll_uses=sokuroll_uses)),
-            remote_addr=tuple(ipport))
-        _, protocol = await connect
+        protocol = protocol or Th123HostProtocol(ipport, echo_packet)
         host = HostPostAsset(user, message_body, protocol)
-        await HostListObserver.append(host)
+        if await HostListObserver.append(host) is not None:
+            await ctx.send(REPLACED_MESSAGE)
 
     @checks.only_private()
     @commands.command()
@@ -334,7 +839,17 @@ class Hosting(CogMixin, commands.Cog):
         await ctx.send("対戦募集を投稿します。")
         protocol = Th123ClientProtocol()
         host = ClientPostAsset(user, message_body, protocol)
-        await HostListObserver.append(host)
+        if await HostListObserver.append(host) is not None:
+            await ctx.send(REPLACED_MESSAGE)
+
+    @checks.is_manager()
+    @commands.command()
+    async def probestat(self, ctx):
+        """
+        ホスト検知パケットの送信状況を表示します。
+        """
+        scheduler = (await HostListObserver.get_multiplexer()).scheduler
+        await ctx.send(f"検知中のホスト: {len(scheduler)}, 送信レート: {scheduler.probe_rate():.2f} packets/s")
 
     @checks.only_private()
     @commands.command()
@@ -1,5 +1,6 @@
 import cogs
 from cogs.common.errors import OnlyPrivateMessage
+from cogs.common.channels import ChannelRegistry
 from discord.ext import commands
 import discord.utils
 import discord
@@ -25,12 +26,14 @@ class UserHelpCommand(commands.DefaultHelpCommand):
 class Shanghai(commands.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, command_prefix="!", help_command=UserHelpCommand(dm_help=True, sort_commands=False), **kwargs)
+        self.channel_registry = ChannelRegistry(self)
 
     """
     events
     """
     async def on_ready(self):
         logger.info("on ready...")
+        self.channel_registry.resolve()
         guild = self.guilds[0]
         channels = guild.channels
         logger.info(guild.name)
@@ -38,13 +41,13 @@ class Shanghai(commands.Bot):
         logger.info("-----channels\n" + str([c.name for c in channels].join("\n")))
         logger.info('test')
         ch_list = [('info', 'ご利用案内・ルール'), ('hostlist', '募集リスト-hostlist'), ('say-gg', '挨拶・感想-say-gg'), ('beginner', '初心者・初級者交流'), ('th123', '天則雑談'), ('advice', 'アドバイス募集'), ('servermeta', '質問・要望')]
-        ch_mention_dict = dict([(key, discord.utils.get(channels, name=name).mention) for key, name in ch_list])
+        ch_mention_dict = dict([(key, self.channel_registry.get(name).mention) for key, name in ch_list])
         logger.info("-----dict_channels\n" + [v.name for k, v in ch_mention_dict.items()].join('\n'))
         manager_role_mention = discord.utils.get(roles, name='MANAGER').mention
         logger.info("-----manage-role\n" + manager_role_mention)
 
         # 元のメッセージ削除
-        information_ch =  discord.utils.get(channels, name='ご利用案内・ルール')
+        information_ch = self.channel_registry.get('information')
         async for message in information_ch.history(limit=10):
             await message.delete() 
 
@@ -90,11 +93,22 @@ class Shanghai(commands.Bot):
         else:
             logger.exception(type(exception).__name__, exc_info=exception)
 
+    async def on_guild_channel_create(self, channel):
+        self.channel_registry.add(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        self.channel_registry.remove(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        self.channel_registry.update(before, after)
+
+    async def on_webhooks_update(self, channel):
+        self.channel_registry.invalidate_webhooks(channel)
+
     async def on_member_join(self, member):
         guild = self.guilds[0]
-        channels = guild.channels
-        information_ch = discord.utils.get(channels, name='ご利用案内・ルール')
-        default_ch = discord.utils.get(channels, name='サーバー玄関口・雑談')
+        information_ch = self.channel_registry.get('information')
+        default_ch = self.channel_registry.get('entrance')
         members_count = len(guild.members)
         fmt = ("{0.mention}さん、ようこそ{1.name}サーバーへ。\n"
                "あなたは{2}人目の参加者です。\n"
@@ -0,0 +1,71 @@
+import unittest
+
+from cogs.common.channels import ChannelRegistry
+
+
+class Channel:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.fetches = 0
+
+    async def webhooks(self):
+        self.fetches += 1
+        return [f"hook-{self.id}"]
+
+
+class Bot:
+    def __init__(self, channels):
+        self.channels = channels
+        self.scans = 0
+
+    def get_all_channels(self):
+        self.scans += 1
+        return iter(self.channels)
+
+
+class TestChannelRegistry(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.hostlist = Channel(1, "募集リスト-hostlist")
+        self.jp_en = Channel(2, "jp-en")
+        self.bot = Bot([self.hostlist, self.jp_en])
+        self.registry = ChannelRegistry(self.bot)
+
+    def test_get_scans_once(self):
+        self.assertIs(self.registry.get('hostlist'), self.hostlist)
+        self.assertIs(self.registry.get("jp-en"), self.jp_en)
+        self.assertIs(self.registry.get_by_id(2), self.jp_en)
+        self.assertIsNone(self.registry.get('en-jp'))
+        self.assertEqual(self.bot.scans, 1)
+
+    def test_channel_events(self):
+        self.registry.resolve()
+        en_jp = Channel(3, "en-jp")
+        self.registry.add(en_jp)
+        self.assertIs(self.registry.get('en-jp'), en_jp)
+
+        renamed = Channel(2, "jp-en-old")
+        self.registry.update(self.jp_en, renamed)
+        self.assertIsNone(self.registry.get('jp-en'))
+        self.assertIs(self.registry.get("jp-en-old"), renamed)
+
+        self.registry.remove(self.hostlist)
+        self.assertIsNone(self.registry.get('hostlist'))
+        self.assertEqual(self.bot.scans, 1)
+
+    def test_remove_falls_back_to_same_name(self):
+        duplicate = Channel(4, "募集リスト-hostlist")
+        self.bot.channels.append(duplicate)
+        self.assertIs(self.registry.get('hostlist'), self.hostlist)
+        self.registry.remove(self.hostlist)
+        self.assertIs(self.registry.get('hostlist'), duplicate)
+
+    async def test_webhook_cached(self):
+        self.assertEqual(await self.registry.webhook('jp-en'), "hook-2")
+        self.assertEqual(await self.registry.webhook('jp-en'), "hook-2")
+        self.assertEqual(self.jp_en.fetches, 1)
+
+        self.registry.invalidate_webhooks(self.jp_en)
+        await self.registry.webhook('jp-en')
+        self.assertEqual(self.jp_en.fetches, 2)
+        self.assertIsNone(await self.registry.webhook('en-jp'))
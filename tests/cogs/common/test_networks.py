@@ -1,7 +1,7 @@
 import unittest
 from unittest.mock import (patch, MagicMock)
 
-from datetime import (datetime, timedelta)
+from datetime import timedelta
 import time
 
 from cogs.common import networks
@@ -22,11 +22,10 @@ class testLifetime(unittest.TestCase):
         lifetime = networks.Lifetime(arg)
 
         time.sleep(.1)
-        self.assertNotEqual(lifetime.ack_datetime, datetime.now())
-
-        ack_datetime = lifetime.ack_datetime
+        deadline = lifetime.deadline
         lifetime.reset()
-        self.assertNotEqual(lifetime.ack_datetime, ack_datetime)
+        self.assertAlmostEqual(
+            .1, (lifetime.deadline - deadline) / 1e9, places=1)
 
     def test_elapsed_datetime(self):
         for arg in (timedelta(seconds=1), timedelta(seconds=2)):
@@ -59,6 +58,74 @@ class testLifetime(unittest.TestCase):
                 self.assertTrue(lifetime.is_expired())
 
 
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = networks.TimerWheel(tick=timedelta(milliseconds=10), size=8)
+
+    def test_advance(self):
+        short = networks.Lifetime(timedelta(milliseconds=50))
+        long = networks.Lifetime(timedelta(seconds=1))
+        self.wheel.schedule(short, 'short')
+        self.wheel.schedule(long, 'long')
+
+        self.assertEqual(self.wheel.advance(), [])
+        self.assertEqual(self.wheel.advance(short.deadline), ['short'])
+        self.assertEqual(self.wheel.advance(short.deadline), [])
+        self.assertEqual(self.wheel.advance(long.deadline), ['long'])
+
+    def test_reset_postpones_expiry(self):
+        lifetime = networks.Lifetime(timedelta(milliseconds=50))
+        self.wheel.schedule(lifetime, 'key')
+        deadline = lifetime.deadline
+
+        time.sleep(.03)
+        lifetime.reset()
+        self.assertEqual(self.wheel.advance(deadline), [])
+        self.assertEqual(self.wheel.advance(lifetime.deadline), ['key'])
+
+        lifetime.reset()
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(lifetime.deadline), ['key'])
+
+    def test_cancel(self):
+        lifetime = networks.Lifetime(timedelta(milliseconds=50))
+        self.wheel.schedule(lifetime, 'key')
+        self.wheel.cancel(lifetime)
+
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.wheel.advance(lifetime.deadline), [])
+
+
+class TestLinkQuality(unittest.TestCase):
+    def test_rtt(self):
+        quality = networks.LinkQuality()
+        self.assertEqual(quality.indicator(), '')
+        self.assertFalse(quality.received(0))
+
+        quality.sent(0)
+        self.assertTrue(quality.received(40_000_000))
+        self.assertEqual(quality.srtt, 40_000_000)
+        self.assertEqual(quality.indicator(), '`40ms`')
+
+        quality.sent(100_000_000)
+        quality.received(148_000_000)
+        self.assertEqual(quality.srtt, 41_000_000)
+        self.assertEqual(quality.rttvar, 20_000_000 * .75 + 8_000_000 * .25)
+        self.assertEqual(quality.indicator(), '`40ms`')
+
+    def test_loss(self):
+        quality = networks.LinkQuality(window=4)
+        quality.sent(0)
+        quality.received(10_000_000)
+        for now in (20_000_000, 30_000_000, 40_000_000):
+            quality.sent(now)
+        self.assertFalse(quality.received(45_000_000))
+        self.assertEqual(quality.srtt, 10_000_000)
+        self.assertEqual(quality.loss(), .5)
+        self.assertEqual(quality.indicator(), '`10ms 50%lost`')
+        self.assertEqual(quality.indicator(), '`10ms 50%lost`')
+
+
 class TestIpPort(unittest.TestCase):
     def test_dunder_init(self):
         with self.assertRaises(AssertionError):
@@ -80,6 +147,10 @@ class TestIpPort(unittest.TestCase):
             networks.IpPort.create('192.168.1.1', 10800),
             networks.IpPort)
 
+        for port in (-1, 0x10000):
+            with self.assertRaises(ValueError):
+                networks.IpPort.create('192.0.2.0', port)
+
     def test_create_with_str(self):
         self.assertIsInstance(
             networks.IpPort.create_with_str('192.0.2.0:7500'),
@@ -136,6 +207,36 @@ class TestIpPort(unittest.TestCase):
         ipport = networks.IpPort.create_with_bin(b'*0\xc0\xa8\x01\x01')
         self.assertEqual(tuple(ipport), ('192.168.1.1', 10800))
 
+    def test_hash_and_eq(self):
+        ipport_a = networks.IpPort.create('192.168.1.1', 10800)
+        ipport_b = networks.IpPort.create_with_str('192.168.1.1:10800')
+        ipport_c = networks.IpPort.create_with_bin(b'*0\xc0\xa8\x01\x01')
+        ipport_d = networks.IpPort.create_with_str('192.168.1.1:10801')
+
+        self.assertEqual(ipport_a, ipport_b)
+        self.assertEqual(ipport_b, ipport_c)
+        self.assertNotEqual(ipport_a, ipport_d)
+        self.assertEqual(len({ipport_a, ipport_b, ipport_c, ipport_d}), 2)
+        self.assertEqual({ipport_a: 1}[ipport_c], 1)
+
+    def test_create_interns(self):
+        self.assertIs(
+            networks.IpPort.create('192.0.2.0', 7500),
+            networks.IpPort.create('192.0.2.0', 7500))
+
+        with self.assertRaises(ValueError):
+            networks.IpPort.create('192.0.2.256', 7500)
+
+    def test_create_with_str_validation(self):
+        for ip_port in ('192.0.2.0', '192.0.2.0:port', '192.0.2.256:7500', '192.0.2.0:65535'):
+            with self.subTest(ip_port=ip_port):
+                with self.assertRaises(ValueError):
+                    networks.IpPort.create_with_str(ip_port)
+
+        self.assertEqual(
+            str(networks.IpPort.create_with_str('１９２.０.２.０：７５００')),
+            '192.0.2.0:7500')
+
 
 class TestTh123Packet(unittest.TestCase):
     def test_packet_01(self):
@@ -304,3 +405,126 @@ class TestTh123Packet(unittest.TestCase):
     def test_packet_0e_sp(self):
         packet = networks.Th123Packet.packet_0e_sp()
         self.assertEqual(packet, bytes.fromhex('0e0103'))
+
+    def test_packet_0e_watch(self):
+        packet = networks.Th123Packet.packet_0e_watch()
+        self.assertEqual(packet, bytes.fromhex('0e0bffffffff00'))
+
+    def test_packet_0e_replay_request(self):
+        packet = networks.Th123Packet.packet_0e_replay_request(0x5a4b3c2d, 3)
+        self.assertEqual(packet, bytes.fromhex('0e0b2d3c4b5a03'))
+
+    def test_constant_packets_are_cached(self):
+        for factory in (
+            networks.Th123Packet.packet_03,
+            networks.Th123Packet.packet_07,
+            networks.Th123Packet.packet_0b,
+            networks.Th123Packet.packet_0e_watch,
+            networks.Th123Packet.packet_05,
+        ):
+            with self.subTest(factory=factory.__name__):
+                self.assertIs(factory(), factory())
+
+        self.assertIs(
+            networks.Th123Packet.packet_05(sokuroll_uses=True),
+            networks.Th123Packet.packet_05(sokuroll_uses=True))
+
+    def test_match_header(self):
+        packet = networks.Th123Packet(
+            bytes.fromhex('0d04' '0102' '00' '14')
+            + bytes(range(40))
+            + bytes.fromhex('03' '0405' '00' '14')
+            + bytes(range(40, 80))
+            + bytes.fromhex('02' '0a' '0b' '2d3c4b5a' '07'))
+        self.assertEqual(packet.get_characters(), (0x01, 0x04))
+        self.assertEqual(packet.get_colors(), (0x02, 0x05))
+        self.assertEqual(packet.get_deck_sizes(), (20, 20))
+        self.assertEqual(packet.get_1p_decks()[0], 0x0100)
+        self.assertEqual(packet.get_2p_decks()[-1], 0x4f4e)
+        self.assertEqual(len(packet.get_2p_decks()), 20)
+        self.assertEqual(packet.get_simultaneous_buttons(), (0x03, 0x02))
+        self.assertEqual(packet.get_stage(), 0x0a)
+        self.assertEqual(packet.get_bgm(), 0x0b)
+        self.assertEqual(packet.get_seed(), 0x5a4b3c2d)
+        self.assertEqual(packet.get_matching_count(), 0x07)
+        self.assertIs(packet.get_match_header(), packet.decoded)
+
+        self.assertIsNone(networks.Th123Packet.packet_0d_sp().get_match_header())
+        self.assertIsNone(networks.Th123Packet(bytes.fromhex('0d04')).get_match_header())
+
+    def test_replay_chunk(self):
+        packet = networks.Th123Packet(bytes.fromhex('0d0900' 'a5b4c3'))
+        self.assertEqual(bytes(packet.decoded.payload), bytes.fromhex('a5b4c3'))
+
+
+class TestTh123ReplayPacket(unittest.TestCase):
+    def test_get_game_inputs(self):
+        packet = networks.Th123ReplayPacket(
+            bytes.fromhex('01000000' '03000000' '01' '03' 'a1a2' 'b1b2' 'c1c2'))
+        self.assertEqual(packet.get_frame_id(), 1)
+        self.assertEqual(packet.get_end_frame_id(), 3)
+        self.assertEqual(
+            packet.get_game_inputs(),
+            list(bytes.fromhex('c1c2' 'b1b2' 'a1a2')))
+        self.assertEqual(
+            packet.get_game_inputs_array().tobytes(),
+            bytes.fromhex('c1c2' 'b1b2' 'a1a2'))
+
+    def test_join_game_inputs(self):
+        packets = [
+            networks.Th123ReplayPacket(bytes(10) + bytes.fromhex('a1a2' 'b1b2')),
+            networks.Th123ReplayPacket(bytes(10) + bytes.fromhex('c1c2')),
+        ]
+        self.assertEqual(
+            networks.Th123ReplayPacket.join_game_inputs(packets).tobytes(),
+            bytes.fromhex('b1b2' 'a1a2' 'c1c2'))
+
+
+class TestTh123Dispatcher(unittest.TestCase):
+    def test_dispatch(self):
+        dispatcher = networks.Th123Dispatcher()
+        owner = MagicMock()
+        dispatcher.route(0x07)(owner.on_07)
+        dispatcher.route(0x0d)(owner.on_0d)
+        dispatcher.route(0x0d04)(owner.on_0d04)
+
+        self.assertTrue(dispatcher.dispatch(owner, b'\x07\x01', 'addr'))
+        owner.on_07.assert_called_once_with(owner, b'\x07\x01', 'addr')
+
+        self.assertTrue(dispatcher.dispatch(owner, b'\x0d\x04'))
+        owner.on_0d04.assert_called_once_with(owner, b'\x0d\x04')
+
+        self.assertTrue(dispatcher.dispatch(owner, b'\x0d\x09'))
+        owner.on_0d.assert_called_once_with(owner, b'\x0d\x09')
+
+        self.assertFalse(dispatcher.dispatch(owner, b'\x0e\x04'))
+        self.assertFalse(dispatcher.dispatch(owner, b'\xff'))
+        self.assertFalse(dispatcher.dispatch(owner, b'\xff'))
+        self.assertFalse(dispatcher.dispatch(owner, b''))
+        self.assertEqual(dispatcher.unknown, {0x0e: 1, 0xff: 2, None: 1})
+
+
+class TestHostStatus(unittest.TestCase):
+    def test_dunder_call(self):
+        for packet, expected in (
+            (b'\x07\x01\x00\x00\x00', (True, False, True)),
+            (b'\x07\x00\x00\x00\x00', (True, False, False)),
+            (b'\x07\x02\x00\x00\x00', (False, False, False)),
+            (b'\x08\x01\x00\x00\x00', (True, True, False)),
+            (b'\x08\x00\x00\x00\x00', (False, False, False)),
+            (b'\x07', (False, False, False)),
+            (b'\x03', (False, False, False)),
+            (b'', (False, False, False)),
+        ):
+            with self.subTest(packet=packet):
+                status = networks.HostStatus()
+                status(packet)
+                self.assertEqual(
+                    (status.hosting, status.matching, status.watchable),
+                    expected)
+
+        status = networks.HostStatus()
+        status(b'\x07\x01')
+        status(memoryview(b'\x08\x01'))
+        self.assertTrue(status.matching)
+        self.assertTrue(status.watchable)
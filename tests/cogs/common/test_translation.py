@@ -0,0 +1,395 @@
+import unittest
+
+import asyncio
+from datetime import timedelta
+import os
+import sqlite3
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+from cogs.common import translation
+
+
+class TestSegments(unittest.TestCase):
+    def test_split(self):
+        for text, parts in (
+            ("よろしく。対戦しましょう！\nIP: 198.51.100.1", ["よろしく。対戦しましょう！", "\n", "IP: 198.51.100.1"]),
+            ("Hello. How are you? gg!!", ["Hello. How are you? gg!!"]),
+            ("", [""]),
+            ("line\n\n", ["line", "\n\n", ""]),
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(translation.split_segments(text), parts)
+                self.assertEqual(''.join(translation.split_segments(text)), text)
+
+    def test_detect_language(self):
+        for text, lang in (
+            ("よろしくお願いします", 'JA'),
+            ("対戦ありがとうございました", 'JA'),
+            ("gg", 'EN'),
+            ("IP: 198.51.100.1", 'EN'),
+            ("ｇｇ", 'EN'),
+            ("Thanks for the games, see you tomorrow", 'EN'),
+            ("Danke schön, das war ein gutes Spiel", None),
+            ("Danke", None),
+            ("yoroshiku onegaishimasu", None),
+            ("你好，我们来对战吧", None),
+            ("対戦募集", None),
+            ("了解", None),
+            ("感謝", None),
+            ("안녕하세요", 'KO'),
+            ("<@123> よろしく https://example.com/replay", 'JA'),
+            ("123 :smile:", None),
+            ("［＿］", None),
+            ("日本語 with some English words here", None),
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(translation.detect_language(text), lang)
+
+    def test_is_translatable(self):
+        self.assertTrue(translation.is_translatable("gg"))
+        self.assertFalse(translation.is_translatable("!? "))
+
+
+class FakeDeepl:
+    def __init__(self):
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.status = 200
+        self.statuses = []
+        self.delay = 0
+        self.usage = {'character_count': 0, 'character_limit': 500000}
+
+    async def handle(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            form = await request.post()
+            self.requests.append((request.headers.get('Authorization'), form.getall('text'), form['target_lang']))
+            await asyncio.sleep(self.delay)
+            status = self.statuses.pop(0) if self.statuses else self.status
+            if status != 200:
+                return web.Response(status=status, text="quota")
+            return web.json_response({'translations': [
+                {'detected_source_language': "JA", 'text': f"{form['target_lang']}:{text}"}
+                for text in form.getall('text')]})
+        finally:
+            self.in_flight -= 1
+
+    async def handle_usage(self, request):
+        return web.json_response(self.usage)
+
+
+class DeeplServerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.deepl = FakeDeepl()
+        app = web.Application()
+        app.router.add_post('/v2/translate', self.deepl.handle)
+        app.router.add_get('/v2/usage', self.deepl.handle_usage)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoint = f"http://127.0.0.1:{port}/v2/translate"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+
+class TestDeeplClient(DeeplServerTestCase):
+    async def test_translate(self):
+        client = translation.DeeplClient("key", self.endpoint)
+        try:
+            response = await client.translate("こんにちは", "EN")
+            self.assertEqual(response['translations'][0]['text'], "EN:こんにちは")
+            session = client._get_session()
+            await client.translate("さようなら", "EN")
+            self.assertIs(client._get_session(), session)
+        finally:
+            await client.close()
+        self.assertEqual(self.deepl.requests[0], ("DeepL-Auth-Key key", ["こんにちは"], "EN"))
+
+    async def test_concurrency_limit(self):
+        self.deepl.delay = 0.05
+        client = translation.DeeplClient("key", self.endpoint, max_concurrency=2)
+        try:
+            await asyncio.gather(*(client.translate(str(i), "EN") for i in range(6)))
+        finally:
+            await client.close()
+        self.assertEqual(len(self.deepl.requests), 6)
+        self.assertLessEqual(self.deepl.max_in_flight, 2)
+
+    async def test_error_and_timeout(self):
+        client = translation.DeeplClient("key", self.endpoint, timeout=timedelta(seconds=0.05))
+        try:
+            self.deepl.status = 456
+            with self.assertRaises(translation.DeeplError) as cm:
+                await client.translate("text", "EN")
+            self.assertEqual(cm.exception.status, 456)
+
+            self.deepl.status = 200
+            self.deepl.delay = 0.5
+            with self.assertRaises((asyncio.TimeoutError, aiohttp.ClientError)):
+                await client.translate("text", "EN")
+        finally:
+            await client.close()
+
+
+class TestTranslationCache(unittest.TestCase):
+    def test_normalized_key(self):
+        cache = translation.TranslationCache()
+        cache.put("gg ", "en", "gg")
+        self.assertEqual(cache.get("gg", "EN"), "gg")
+        self.assertIsNone(cache.get("gg", "JA"))
+        self.assertIsNone(cache.get("ｇｇ", "EN"))
+        self.assertEqual((cache.hits, cache.misses, cache.saved_chars), (1, 2, 2))
+        self.assertEqual(cache.hit_rate(), 1 / 3)
+
+    def test_lru_eviction(self):
+        cache = translation.TranslationCache(capacity=2)
+        cache.put("a", "EN", "A")
+        cache.put("b", "EN", "B")
+        cache.get("a", "EN")
+        cache.put("c", "EN", "C")
+        self.assertEqual(cache.get("a", "EN"), "A")
+        self.assertIsNone(cache.get("b", "EN"))
+
+    def test_persistent_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite3")
+            cache = translation.TranslationCache(path, capacity=1)
+            cache.put("よろしくお願いします", "EN", "Nice to meet you")
+            cache.put("gg", "JA", "GG")
+            cache.close()
+
+            cache = translation.TranslationCache(path)
+            self.assertEqual(cache.get("よろしくお願いします", "EN"), "Nice to meet you")
+            self.assertEqual(cache.get("gg", "JA"), "GG")
+            self.assertEqual(cache.saved_chars, 12)
+            cache.close()
+
+    def test_disk_capacity(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite3")
+            cache = translation.TranslationCache(path, capacity=1, disk_capacity=10)
+            cache._writes.max_pending = 4
+            for i in range(8):
+                cache.put(str(i), "EN", f"<{i}>")
+            self.assertEqual(cache.get("0", "EN"), "<0>")
+            for i in range(8, 16):
+                cache.put(str(i), "EN", f"<{i}>")
+            cache.close()
+
+            cache = translation.TranslationCache(path, capacity=1)
+            self.assertEqual(cache._rows, 11)
+            self.assertEqual(cache.get("0", "EN"), "<0>")
+            self.assertIsNone(cache.get("1", "EN"))
+            self.assertEqual(cache.get("15", "EN"), "<15>")
+            cache.close()
+
+
+class TestTokenBucket(unittest.IsolatedAsyncioTestCase):
+    async def test_rate(self):
+        bucket = translation.TokenBucket(rate=100, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertGreater(bucket.reserve(), 0)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for _ in range(3):
+            await bucket.acquire()
+        self.assertGreaterEqual(loop.time() - started, .02)
+
+
+class TestTranslationQueue(DeeplServerTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.client = translation.DeeplClient("key", self.endpoint)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await super().asyncTearDown()
+
+    def create_queue(self, **kwargs):
+        queue = translation.TranslationQueue(self.client, backoff=timedelta(milliseconds=10), **kwargs)
+        self.addCleanup(queue.close)
+        return queue
+
+    async def test_new_messages_first(self):
+        queue = self.create_queue(workers=1)
+        await queue.translate("warmup", "EN")
+        results = await asyncio.gather(
+            queue.translate("edit", "EN", translation.PRIORITY_EDIT),
+            queue.translate("new", "EN", translation.PRIORITY_NEW))
+        self.assertEqual([r['translations'][0]['text'] for r in results], ["EN:edit", "EN:new"])
+        self.assertEqual([texts for _, texts, _ in self.deepl.requests[1:]], [["new"], ["edit"]])
+
+    async def test_retry_with_backoff(self):
+        self.deepl.statuses = [429, 503]
+        queue = self.create_queue()
+        response = await queue.translate("gg", "JA")
+        self.assertEqual(response['translations'][0]['text'], "JA:gg")
+        self.assertEqual(len(self.deepl.requests), 3)
+        self.assertEqual(queue.character_count, 2)
+
+        self.deepl.status = 403
+        with self.assertRaises(translation.DeeplError):
+            await queue.translate("gg", "JA")
+
+    async def test_quota(self):
+        self.deepl.usage = {'character_count': 99, 'character_limit': 100}
+        queue = self.create_queue()
+        await queue.translate("a", "EN")
+        self.assertEqual(queue.headroom(), 0)
+        with self.assertRaises(translation.DeeplError) as cm:
+            await queue.translate("b", "EN")
+        self.assertEqual(cm.exception.status, 456)
+        self.assertEqual(len(self.deepl.requests), 1)
+
+    async def test_quota_used_up(self):
+        self.deepl.usage = {'character_count': 0, 'character_limit': 100}
+        self.deepl.statuses = [456]
+        queue = self.create_queue(usage_interval=timedelta(milliseconds=50))
+        # assertRaises would clear the frames of the traceback, which include the worker's.
+        for _ in range(2):
+            result, = await asyncio.gather(queue.translate("a", "EN"), return_exceptions=True)
+            self.assertIsInstance(result, translation.DeeplError)
+            self.assertEqual(result.status, 456)
+        self.assertEqual(len(self.deepl.requests), 1)
+        self.assertEqual(queue.headroom(), 0)
+
+        await asyncio.sleep(.06)
+        response = await queue.translate("a", "EN")
+        self.assertEqual(response['translations'][0]['text'], "EN:a")
+        self.assertEqual(len(self.deepl.requests), 2)
+
+    async def test_shed_lowest_priority(self):
+        self.deepl.delay = 0.05
+        queue = self.create_queue(workers=1, max_depth=1)
+        first = asyncio.ensure_future(queue.translate("first", "EN"))
+        await asyncio.sleep(0.01)
+        results = await asyncio.gather(
+            queue.translate("edit", "EN", translation.PRIORITY_EDIT),
+            queue.translate("new", "EN", translation.PRIORITY_NEW),
+            return_exceptions=True)
+        await first
+        self.assertIsInstance(results[0], translation.TranslationShed)
+        self.assertEqual(results[1]['translations'][0]['text'], "EN:new")
+        self.assertEqual(queue.shed, 1)
+
+
+class TestTranslationBatcher(DeeplServerTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.client = translation.DeeplClient("key", self.endpoint)
+        self.queue = translation.TranslationQueue(self.client, backoff=timedelta(milliseconds=10))
+
+    async def asyncTearDown(self):
+        self.queue.close()
+        await self.client.close()
+        await super().asyncTearDown()
+
+    async def test_window(self):
+        batcher = translation.TranslationBatcher(self.queue, window=timedelta(milliseconds=20))
+        results = await asyncio.gather(
+            batcher.translate("a", "EN"),
+            batcher.translate("b", "JA"),
+            batcher.translate("c", "EN"))
+        self.assertEqual(results, ["EN:a", "JA:b", "EN:c"])
+        self.assertCountEqual([texts for _, texts, _ in self.deepl.requests], [["a", "c"], ["b"]])
+        self.assertEqual((batcher.requests, batcher.texts), (2, 3))
+
+    async def test_size_cap(self):
+        batcher = translation.TranslationBatcher(self.queue, window=timedelta(seconds=10), max_batch=2)
+        results = await asyncio.wait_for(asyncio.gather(
+            batcher.translate("a", "EN"),
+            batcher.translate("b", "EN")), 1)
+        self.assertEqual(results, ["EN:a", "EN:b"])
+        self.assertEqual(len(self.deepl.requests), 1)
+
+    async def test_byte_cap(self):
+        batcher = translation.TranslationBatcher(
+            self.queue, window=timedelta(milliseconds=20),
+            max_bytes=translation.TranslationBatcher.encoded_size("あ" * 10) * 2)
+        results = await asyncio.gather(*(batcher.translate("あ" * 10, "EN") for _ in range(3)))
+        self.assertEqual(results, ["EN:" + "あ" * 10] * 3)
+        self.assertCountEqual([len(texts) for _, texts, _ in self.deepl.requests], [2, 1])
+
+    async def test_mismatched_response(self):
+        batcher = translation.TranslationBatcher(self.queue, window=timedelta(milliseconds=10))
+
+        async def translate(texts, target_lang, priority):
+            return {'translations': [{'text': "only one"}]}
+
+        self.queue.translate = translate
+        results = await asyncio.wait_for(asyncio.gather(
+            batcher.translate("a", "EN"),
+            batcher.translate("b", "EN"),
+            return_exceptions=True), 1)
+        self.assertTrue(all(isinstance(r, translation.DeeplError) for r in results))
+
+    async def test_error_fans_out(self):
+        self.deepl.status = 403
+        batcher = translation.TranslationBatcher(self.queue, window=timedelta(milliseconds=10))
+        results = await asyncio.gather(
+            batcher.translate("a", "EN"),
+            batcher.translate("b", "EN"),
+            return_exceptions=True)
+        self.assertTrue(all(isinstance(r, translation.DeeplError) for r in results))
+        self.assertEqual(len(self.deepl.requests), 1)
+
+
+class TestMessageMap(unittest.TestCase):
+    def test_bounded(self):
+        send_ids = translation.MessageMap(capacity=2)
+        send_ids[1] = 11
+        send_ids[2] = 12
+        send_ids[3] = 13
+        self.assertNotIn(1, send_ids)
+        self.assertEqual(send_ids.get(3), 13)
+        self.assertEqual(len(send_ids), 2)
+        self.assertEqual(send_ids.pop(2), 12)
+        self.assertIsNone(send_ids.pop(2))
+        self.assertIsNone(send_ids.pop(1))
+
+    def test_persistent(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite3")
+            send_ids = translation.MessageMap(path, capacity=3)
+            for origin in range(1, 6):
+                send_ids[origin] = {"en-jp": origin + 10}
+            send_ids.pop(4)
+            send_ids.close()
+
+            send_ids = translation.MessageMap(path, capacity=1)
+            self.assertEqual(len(send_ids), 1)
+            self.assertEqual(send_ids.get(5), {"en-jp": 15})
+            send_ids.close()
+
+            send_ids = translation.MessageMap(path, capacity=3)
+            self.assertEqual(len(send_ids), 1)
+            send_ids.close()
+
+    def test_batched_writes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.sqlite3")
+            send_ids = translation.MessageMap(path)
+            send_ids._writes.max_pending = 3
+            reader = sqlite3.connect(path)
+            count = "SELECT COUNT(*) FROM message_map"
+            send_ids[1] = {"en-jp": 11}
+            send_ids[2] = {"en-jp": 12}
+            self.assertEqual(reader.execute(count).fetchone()[0], 0)
+            send_ids.pop(1)
+            send_ids[3] = {"en-jp": 13}
+            self.assertEqual(reader.execute(count).fetchone()[0], 2)
+            send_ids[4] = {"en-jp": 14}
+            self.assertEqual(reader.execute(count).fetchone()[0], 2)
+            send_ids.close()
+            self.assertEqual(reader.execute(count).fetchone()[0], 3)
+            reader.close()
@@ -0,0 +1,51 @@
+import unittest
+
+import asyncio
+
+from cogs.common import udp
+
+
+class Recorder(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.received = []
+        self.arrived = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received.append((type(data), bytes(data), addr))
+        self.arrived.set()
+
+
+class TestBufferedDatagramTransport(unittest.IsolatedAsyncioTestCase):
+    async def test_batched_receive(self):
+        loop = asyncio.get_running_loop()
+        server, server_protocol = await udp.create_datagram_endpoint(
+            loop, Recorder, local_addr=('127.0.0.1', 0), batch_size=4)
+        server_addr = server.get_extra_info('sockname')
+        client, client_protocol = await udp.create_datagram_endpoint(
+            loop, Recorder, remote_addr=server_addr)
+        self.assertIs(client_protocol.transport, client)
+
+        for i in range(10):
+            client.sendto(bytes([i]) * (i + 1))
+        while len(server_protocol.received) < 10:
+            server_protocol.arrived.clear()
+            await asyncio.wait_for(server_protocol.arrived.wait(), 1)
+
+        client_addr = client.get_extra_info('sockname')
+        self.assertEqual(
+            server_protocol.received,
+            [(memoryview, bytes([i]) * (i + 1), client_addr) for i in range(10)])
+
+        server.sendto(b'\x07\x01', client_addr)
+        await asyncio.wait_for(client_protocol.arrived.wait(), 1)
+        self.assertEqual(client_protocol.received[0][1], b'\x07\x01')
+
+        client.close()
+        server.close()
+        self.assertTrue(server.is_closing())
+        await asyncio.sleep(0)
+        self.assertEqual(server.get_extra_info('socket').fileno(), -1)
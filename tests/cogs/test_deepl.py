@@ -0,0 +1,270 @@
+import unittest
+
+import asyncio
+from datetime import timedelta
+import discord
+import itertools
+import os
+from unittest.mock import (patch, MagicMock)
+
+from cogs import deepl
+from cogs.common.channels import ChannelRegistry
+
+
+class FakeWebhook:
+    _ids = itertools.count(100)
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, *, content, wait, username, avatar_url):
+        message = FakeMessage(next(self._ids), self.channel, content, FakeAuthor(username, bot=True))
+        self.channel.messages[message.id] = message
+        return message
+
+    async def edit_message(self, message_id, *, content, username, avatar_url):
+        self.channel.messages[message_id].content = content
+
+
+class FakeChannel:
+    _ids = itertools.count(1)
+
+    def __init__(self, name):
+        self.id = next(self._ids)
+        self.name = name
+        self.messages = {}
+        self.notices = []
+        self.hook = FakeWebhook(self)
+
+    async def webhooks(self):
+        return [self.hook]
+
+    async def send(self, content):
+        self.notices.append(content)
+
+    async def fetch_message(self, message_id):
+        return self.messages[message_id]
+
+
+class FakeAuthor:
+    def __init__(self, name, bot=False):
+        self.name = name
+        self.nick = None
+        self.bot = bot
+        self.avatar_url = None
+
+
+class FakeMessage:
+    def __init__(self, id, channel, content, author, attachments=()):
+        self.id = id
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.attachments = list(attachments)
+
+    async def delete(self):
+        del self.channel.messages[self.id]
+
+
+class FakeBot:
+    def __init__(self, channels):
+        self.channels = channels
+        self.channel_registry = ChannelRegistry(self)
+
+    def get_all_channels(self):
+        return self.channels
+
+
+class TestLoadChannelGroups(unittest.TestCase):
+    def test_load(self):
+        self.assertEqual(deepl.load_channel_groups(deepl.DEFAULT_CHANNEL_GROUPS),
+                         [{"jp-en": "JA", "en-jp": "EN"}])
+        with patch.dict(os.environ, {'DEEPL_CHANNEL_GROUPS': '[{"jp-ko": "ja", "ko-jp": "ko"}]'}):
+            self.assertEqual(deepl.load_channel_groups(), [{"jp-ko": "JA", "ko-jp": "KO"}])
+        for config in ('{"jp-en": "JA"}', '[["jp-en", "JA"]]', '[{"jp-en": 1}]'):
+            with self.subTest(config=config):
+                with self.assertRaises(ValueError):
+                    deepl.load_channel_groups(config)
+
+
+class TestDeliverySequencer(unittest.IsolatedAsyncioTestCase):
+    async def test_source_order(self):
+        sequencer = deepl.DeliverySequencer()
+        delivered = []
+
+        async def post(ticket, delay):
+            await asyncio.sleep(delay)
+
+            async def deliver():
+                delivered.append(ticket)
+                return ticket
+            return await sequencer.commit("en-jp", ticket, deliver)
+
+        tickets = [await sequencer.reserve("en-jp") for _ in range(4)]
+        self.assertEqual(len(sequencer), 4)
+        sequencer.skip("en-jp", tickets[2])
+        results = await asyncio.gather(
+            post(tickets[0], 0.03), post(tickets[1], 0.01), post(tickets[3], 0))
+        self.assertEqual(results, [0, 1, 3])
+        self.assertEqual(delivered, [0, 1, 3])
+        self.assertEqual(len(sequencer), 0)
+
+    async def test_bounded_in_flight(self):
+        sequencer = deepl.DeliverySequencer(max_in_flight=1)
+        ticket = await sequencer.reserve("en-jp")
+        waiting = asyncio.ensure_future(sequencer.reserve("en-jp"))
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        sequencer.skip("en-jp", ticket)
+        self.assertEqual(await waiting, 1)
+
+    async def test_retry_rate_limited(self):
+        sequencer = deepl.DeliverySequencer(backoff=timedelta(milliseconds=1))
+        attempts = []
+
+        async def deliver():
+            attempts.append(None)
+            if len(attempts) < 3:
+                raise discord.HTTPException(MagicMock(status=429), "rate limited")
+            return "posted"
+
+        ticket = await sequencer.reserve("en-jp")
+        self.assertEqual(await sequencer.commit("en-jp", ticket, deliver), "posted")
+        self.assertEqual(len(attempts), 3)
+
+        async def forbidden():
+            raise discord.HTTPException(MagicMock(status=403), "forbidden")
+
+        ticket = await sequencer.reserve("en-jp")
+        with self.assertRaises(discord.HTTPException):
+            await sequencer.commit("en-jp", ticket, forbidden)
+        self.assertEqual(len(sequencer), 0)
+
+
+class TestDeepl(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.channels = {name: FakeChannel(name) for name in ("jp-en", "en-jp", "zh-jp")}
+        with patch.object(deepl, 'CACHE_PATH', None):
+            self.cog = deepl.Deepl(
+                FakeBot(list(self.channels.values())),
+                deepl.load_channel_groups('[{"jp-en": "JA", "en-jp": "EN", "zh-jp": "zh"}]'))
+        self.translations = []
+
+        async def translate_text(text, target_lang, priority=deepl.PRIORITY_NEW):
+            self.translations.append((text, target_lang, priority))
+            await asyncio.sleep(0.05 if text != "遅い" else 0.1)
+            return f"{target_lang}:{text}"
+
+        self.cog.translate_text = translate_text
+        self.author = FakeAuthor("reimu")
+
+    async def asyncTearDown(self):
+        self.cog.cog_unload()
+        await asyncio.sleep(0)
+
+    def mirrors(self, message_id):
+        return {name: self.channels[name].messages[post['id']].content
+                for name, post in self.cog.send_ids.get(message_id).items()}
+
+    async def test_fan_out_concurrently(self):
+        message = FakeMessage(1, self.channels["jp-en"], "よろしく", self.author)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await self.cog.translate(message)
+        self.assertLess(loop.time() - started, 0.09)
+        self.assertEqual(self.mirrors(1), {"en-jp": "EN:よろしく", "zh-jp": "ZH:よろしく"})
+
+        en_message = FakeMessage(2, self.channels["en-jp"], "gg", self.author)
+        await self.cog.translate(en_message)
+        self.assertEqual(self.mirrors(2), {"jp-en": "JA:gg", "zh-jp": "ZH:gg"})
+
+    async def test_posts_keep_source_order(self):
+        await asyncio.gather(
+            self.cog.translate(FakeMessage(1, self.channels["jp-en"], "遅い", self.author)),
+            self.cog.translate(FakeMessage(2, self.channels["jp-en"], "速い", self.author)))
+        posts = self.channels["en-jp"].messages
+        self.assertEqual([posts[i].content for i in sorted(posts)], ["EN:遅い", "EN:速い"])
+
+    async def test_edit_and_delete(self):
+        message = FakeMessage(1, self.channels["jp-en"], "よろしく", self.author)
+        await self.cog.translate(message)
+        post_ids = {name: post['id'] for name, post in self.cog.send_ids.get(1).items()}
+
+        before = FakeMessage(1, message.channel, message.content, self.author)
+        message.content = "対戦ありがとうございました"
+        await self.cog.re_translate(before, message)
+        self.assertEqual({name: post['id'] for name, post in self.cog.send_ids.get(1).items()}, post_ids)
+        self.assertEqual(self.mirrors(1)["en-jp"], "EN:対戦ありがとうございました")
+        self.assertEqual(self.translations[-1][2], deepl.PRIORITY_EDIT)
+
+        await self.cog.double_delete(message)
+        self.assertEqual(self.channels["en-jp"].messages, {})
+        self.assertEqual(self.channels["zh-jp"].messages, {})
+        await self.cog.double_delete(message)
+
+    async def test_ignored_channel_and_failure(self):
+        other = FakeChannel("雑談")
+        await self.cog.translate(FakeMessage(1, other, "hello", self.author))
+        self.assertEqual(self.translations, [])
+
+        async def fail(text, target_lang, priority=deepl.PRIORITY_NEW):
+            raise Exception("limit")
+
+        self.cog.translate_text = fail
+        await self.cog.translate(FakeMessage(2, self.channels["en-jp"], "hello", self.author))
+        self.assertEqual(self.channels["en-jp"].notices, [deepl.FAILED_MESSAGES["EN"]])
+        self.assertNotIn(2, self.cog.send_ids)
+
+    def translate_lines(self, translated):
+        del self.cog.translate_text
+
+        async def translate(text, target_lang, priority=deepl.PRIORITY_NEW):
+            translated.append((text, target_lang))
+            return '\n'.join(f"<{line}>" for line in text.split('\n'))
+
+        self.cog.batcher.translate = translate
+
+    async def test_incremental_edit(self):
+        translated = []
+        self.translate_lines(translated)
+        message = FakeMessage(1, self.channels["jp-en"], "よろしく。対戦しましょう！\nIP: 198.51.100.1", self.author)
+        await self.cog.translate(message)
+        self.assertCountEqual(translated, [
+            ("よろしく。対戦しましょう！", "EN"), ("よろしく。対戦しましょう！\nIP: 198.51.100.1", "ZH")])
+        self.assertEqual(self.mirrors(1)["en-jp"], "<よろしく。対戦しましょう！>\nIP: 198.51.100.1")
+        self.assertEqual(self.mirrors(1)["zh-jp"], "<よろしく。対戦しましょう！>\n<IP: 198.51.100.1>")
+
+        before = FakeMessage(1, message.channel, message.content, self.author)
+        await self.cog.re_translate(before, message)
+        self.assertEqual(len(translated), 2)
+
+        # The unchanged line comes from send_ids, not from the cache.
+        self.cog.cache = deepl.TranslationCache()
+        translated.clear()
+        message.content = "よろしく。対戦しませんか？\n\nIP: 198.51.100.1"
+        await self.cog.re_translate(before, message)
+        self.assertCountEqual(translated, [("よろしく。対戦しませんか？", "EN"), ("よろしく。対戦しませんか？", "ZH")])
+        self.assertEqual(self.mirrors(1)["en-jp"], "<よろしく。対戦しませんか？>\n\nIP: 198.51.100.1")
+        self.assertEqual(self.mirrors(1)["zh-jp"], "<よろしく。対戦しませんか？>\n\n<IP: 198.51.100.1>")
+
+    async def test_line_breaks_lost(self):
+        translated = []
+        self.translate_lines(translated)
+        translate = self.cog.batcher.translate
+
+        async def merge_lines(text, target_lang, priority=deepl.PRIORITY_NEW):
+            return (await translate(text, target_lang, priority)).replace('\n', ' ')
+
+        self.cog.batcher.translate = merge_lines
+        await self.cog.translate(FakeMessage(1, self.channels["en-jp"], "Hello.\nHow are you?", self.author))
+        # One request per language, then one per line.
+        self.assertEqual(len(translated), 2 * 3)
+        self.assertEqual(self.mirrors(1)["jp-en"], "<Hello.>\n<How are you?>")
+
+    async def test_pass_through_target_language(self):
+        translated = []
+        self.translate_lines(translated)
+        await self.cog.translate(FakeMessage(1, self.channels["jp-en"], "Good game!", self.author))
+        self.assertEqual(translated, [("Good game!", "ZH")])
+        self.assertEqual(self.mirrors(1), {"en-jp": "Good game!", "zh-jp": "<Good game!>"})
+        self.assertEqual(self.cog.passed_chars, len("Good game!"))
@@ -0,0 +1,362 @@
+import unittest
+
+import asyncio
+from datetime import timedelta
+import discord
+from unittest.mock import (patch, AsyncMock, MagicMock)
+
+from cogs import hosting
+from cogs.common import networks, udp
+
+
+class SimulatedHost(asyncio.DatagramProtocol):
+    def __init__(self, reply):
+        self.reply = reply
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.transport.sendto(self.reply, addr)
+
+
+class TestTh123HostMultiplexer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        loop = asyncio.get_running_loop()
+        self.transports = []
+        self.hosts = []
+        for reply in (
+            networks.Th123Packet.packet_07(is_watchable=True),
+            networks.Th123Packet.packet_07(is_watchable=False),
+        ):
+            transport, host = await loop.create_datagram_endpoint(
+                lambda: SimulatedHost(reply), local_addr=('127.0.0.1', 0))
+            self.transports.append(transport)
+            self.hosts.append(
+                (networks.IpPort.create(*transport.get_extra_info('sockname')), host))
+
+        scheduler = hosting.ProbeScheduler(
+            min_interval=timedelta(milliseconds=50),
+            max_interval=timedelta(milliseconds=50))
+        self.transport, self.multiplexer = await udp.create_datagram_endpoint(
+            loop, lambda: hosting.Th123HostMultiplexer(scheduler))
+
+    async def asyncTearDown(self):
+        for transport in self.transports + [self.transport]:
+            transport.close()
+
+    async def test_probe(self):
+        protocols = [
+            hosting.Th123HostProtocol(ipport, networks.Th123Packet.packet_05())
+            for ipport, _ in self.hosts]
+        for protocol in protocols:
+            self.multiplexer.register(protocol)
+
+        await asyncio.sleep(.02)
+        self.assertEqual(
+            [str(protocol.host_status) for protocol in protocols],
+            [':o: :eye:', ':o: :see_no_evil:'])
+
+        protocols[0].discard()
+        received = [host.received for _, host in self.hosts]
+        await asyncio.sleep(.2)
+        self.assertEqual(self.hosts[0][1].received, received[0])
+        self.assertGreater(self.hosts[1][1].received, received[1])
+        self.assertIsNone(protocols[0].multiplexer)
+        self.assertEqual(len(self.multiplexer.scheduler), 1)
+
+
+class TestProbeScheduler(unittest.IsolatedAsyncioTestCase):
+    def create_protocol(self, *, answers):
+        protocol = MagicMock()
+        protocol.host_status = networks.HostStatus()
+        protocol.ack_lifetime = networks.Lifetime(timedelta(seconds=6))
+        if answers:
+            protocol.try_echo.side_effect = protocol.ack_lifetime.reset
+        return protocol
+
+    async def test_backoff(self):
+        scheduler = hosting.ProbeScheduler(
+            min_interval=timedelta(milliseconds=10),
+            silent_interval=timedelta(milliseconds=20),
+            max_interval=timedelta(milliseconds=80),
+            jitter=0,
+            rate_window=timedelta(seconds=1))
+        stable = self.create_protocol(answers=True)
+        silent = self.create_protocol(answers=False)
+        scheduler.add(stable)
+        scheduler.add(silent)
+
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(.5)
+        task.cancel()
+
+        self.assertLess(stable.try_echo.call_count, 12)
+        self.assertGreater(silent.try_echo.call_count, 15)
+        self.assertLess(silent.try_echo.call_count, 30)
+        self.assertAlmostEqual(
+            scheduler.probe_rate(),
+            stable.try_echo.call_count + silent.try_echo.call_count)
+
+        scheduler.remove(silent)
+        self.assertEqual(len(scheduler), 1)
+
+    async def test_survives_errors(self):
+        scheduler = hosting.ProbeScheduler(min_interval=timedelta(milliseconds=10), jitter=0)
+        failing = self.create_protocol(answers=True)
+        failing.try_echo.side_effect = OSError
+        scheduler.add(failing)
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(.05)
+        self.assertFalse(task.done())
+        self.assertGreater(failing.try_echo.call_count, 1)
+        task.cancel()
+
+
+class TestTh123HostProtocol(unittest.TestCase):
+    @patch('cogs.common.networks.time.monotonic_ns', MagicMock(return_value=0))
+    def test_unanswered_probes_update_render(self):
+        ipport = networks.IpPort.create_with_str('192.0.2.0:7500')
+        protocol = hosting.Th123HostProtocol(ipport, networks.Th123Packet.packet_05())
+        protocol.connection_made(MagicMock())
+        post = hosting.HostPostAsset(MagicMock(), 'host', protocol)
+        protocol.on_change = MagicMock(side_effect=post.invalidate)
+        reply = networks.Th123Packet.packet_07(is_watchable=True)
+        addr = tuple(ipport)
+
+        for _ in range(10):
+            protocol.try_echo()
+            protocol.datagram_received(reply, addr)
+        self.assertIn('`0ms`', post.render())
+        protocol.on_change.reset_mock()
+
+        for _ in range(3):
+            protocol.try_echo()
+        protocol.datagram_received(reply, addr)
+        self.assertEqual(protocol.quality.indicator(), '`0ms 17%lost`')
+        self.assertIn(protocol.quality.indicator(), post.render())
+        protocol.on_change.assert_called()
+
+
+class TestHostRegistry(unittest.TestCase):
+    def test_index(self):
+        registry = hosting.HostRegistry()
+        ipport = networks.IpPort.create_with_str('192.0.2.0:7500')
+        protocol = hosting.Th123HostProtocol(ipport, networks.Th123Packet.packet_05())
+        user_a, user_b = MagicMock(id=1), MagicMock(id=2)
+        post_a = hosting.HostPostAsset(user_a, 'a', protocol)
+        post_b = hosting.HostPostAsset(user_b, 'b', protocol)
+
+        self.assertTrue(registry.add(post_a))
+        self.assertFalse(registry.add(post_b))
+        self.assertEqual(list(registry), [post_a, post_b])
+        self.assertIs(registry.find_by_user(MagicMock(id=2), hosting.HostPostAsset), post_b)
+        self.assertIsNone(registry.find_by_user(MagicMock(id=2), hosting.ClientPostAsset))
+        self.assertIs(registry.find_protocol(networks.IpPort.create('192.0.2.0', 7500)), protocol)
+        self.assertEqual(registry.posts_of(protocol), [post_a, post_b])
+
+        self.assertFalse(registry.remove(post_a))
+        self.assertIsNone(registry.find_by_user(user_a, hosting.HostPostAsset))
+        self.assertEqual(registry.posts_by_user(user_a), [])
+        self.assertTrue(registry.remove(post_b))
+        self.assertIsNone(registry.find_protocol(ipport))
+        self.assertEqual(len(registry), 0)
+
+    def test_slots(self):
+        post = hosting.ClientPostAsset(MagicMock(), 'body', hosting.Th123ClientProtocol())
+        with self.assertRaises(AttributeError):
+            post.extra = None
+
+
+class TestNotificationOutbox(unittest.IsolatedAsyncioTestCase):
+    def create_response(self, status):
+        response = MagicMock()
+        response.status = status
+        return response
+
+    async def test_send(self):
+        outbox = hosting.NotificationOutbox(maxsize=2, backoff=timedelta())
+        self.addCleanup(outbox.close)
+        healthy = MagicMock(id=1, send=AsyncMock())
+        flaky = MagicMock(id=2, send=AsyncMock(side_effect=[
+            discord.HTTPException(self.create_response(500), 'error'), None]))
+        full = MagicMock(id=3, send=AsyncMock())
+
+        self.assertTrue(outbox.send(healthy, 'closed'))
+        self.assertFalse(outbox.send(healthy, 'closed'))
+        self.assertTrue(outbox.send(flaky, 'closed'))
+        self.assertFalse(outbox.send(full, 'closed'))
+        await outbox.join()
+
+        healthy.send.assert_awaited_once_with('closed')
+        self.assertEqual(flaky.send.await_count, 2)
+        full.send.assert_not_awaited()
+
+    async def test_failures_keep_workers(self):
+        outbox = hosting.NotificationOutbox(workers=1, backoff=timedelta())
+        self.addCleanup(outbox.close)
+        closed = MagicMock(id=1, send=AsyncMock(
+            side_effect=discord.Forbidden(self.create_response(403), 'forbidden')))
+        broken = MagicMock(id=2, send=AsyncMock(side_effect=ValueError))
+        healthy = MagicMock(id=3, send=AsyncMock())
+
+        self.assertTrue(outbox.send(closed, 'closed'))
+        self.assertTrue(outbox.send(broken, 'closed'))
+        self.assertTrue(outbox.send(healthy, 'closed'))
+        await asyncio.wait_for(outbox.join(), 1)
+
+        closed.send.assert_awaited_once_with('closed')
+        broken.send.assert_awaited_once_with('closed')
+        healthy.send.assert_awaited_once_with('closed')
+
+
+class TestHostListObserver(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.patchers = [
+            patch.object(hosting.HostListObserver, '_registry', hosting.HostRegistry()),
+            patch.object(hosting.HostListObserver, '_closing', set()),
+            patch.object(hosting.HostListObserver, '_changed', asyncio.Event()),
+            patch.object(hosting.HostListObserver, '_timer_wheel', networks.TimerWheel()),
+            patch.object(hosting.HostListObserver, '_outbox', hosting.NotificationOutbox()),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    async def asyncTearDown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    async def test_publish_only_on_change(self):
+        message = MagicMock()
+        message.edit = AsyncMock()
+        task = asyncio.ensure_future(
+            hosting.HostListObserver.publish(MagicMock(), [message], debounce=timedelta()))
+
+        post = hosting.ClientPostAsset(
+            MagicMock(), 'body', hosting.Th123ClientProtocol())
+        await hosting.HostListObserver.append(post)
+        await asyncio.sleep(.01)
+        self.assertEqual(message.edit.await_count, 1)
+        self.assertIn(':loudspeaker: body', message.edit.await_args.kwargs['content'])
+
+        hosting.HostListObserver.invalidate(post)
+        await asyncio.sleep(.01)
+        self.assertEqual(message.edit.await_count, 1)
+
+        post.message_body = 'edited'
+        hosting.HostListObserver.invalidate(post)
+        await asyncio.sleep(.01)
+        self.assertEqual(message.edit.await_count, 2)
+        self.assertIn(':loudspeaker: edited', message.edit.await_args.kwargs['content'])
+
+        task.cancel()
+
+    async def test_publish_pages(self):
+        def create_message(content):
+            message = MagicMock()
+            message.content = content
+            message.edit = AsyncMock(side_effect=lambda content: setattr(message, 'content', content))
+            message.delete = AsyncMock()
+            return message
+
+        hostlist_ch = MagicMock()
+        hostlist_ch.send = AsyncMock(side_effect=create_message)
+        messages = [create_message('')]
+        task = asyncio.ensure_future(
+            hosting.HostListObserver.publish(hostlist_ch, messages, debounce=timedelta()))
+
+        posts = [
+            hosting.ClientPostAsset(MagicMock(), f'{i:03} ' + 'x' * 300, hosting.Th123ClientProtocol())
+            for i in range(20)]
+        for post in posts:
+            await hosting.HostListObserver.append(post)
+        await asyncio.sleep(.01)
+
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(all(len(message.content) <= 2000 for message in messages))
+        self.assertEqual(
+            ''.join(message.content for message in messages).count(':loudspeaker:'), 20)
+        edits = [message.edit.await_count for message in messages]
+
+        posts[-1].message_body = 'edited'
+        hosting.HostListObserver.invalidate(posts[-1])
+        await asyncio.sleep(.01)
+        self.assertEqual(
+            [message.edit.await_count for message in messages],
+            edits[:-1] + [edits[-1] + 1])
+
+        edits = [message.edit.await_count for message in messages]
+        posts[1].terminate()
+        hosting.HostListObserver.close(posts[1])
+        await asyncio.sleep(.01)
+        self.assertEqual(len(messages), 4)
+        self.assertEqual(
+            [message.edit.await_count for message in messages],
+            [edits[0] + 1] + edits[1:])
+
+        for post in posts[5:]:
+            post.terminate()
+            hosting.HostListObserver.close(post)
+        await asyncio.sleep(.01)
+        self.assertEqual(len(messages), 1)
+
+        task.cancel()
+
+    async def test_publish_recovers(self):
+        deleted = MagicMock()
+        deleted.edit = AsyncMock(side_effect=discord.NotFound(MagicMock(status=404), 'deleted'))
+        deleted.delete = AsyncMock(side_effect=discord.NotFound(MagicMock(status=404), 'deleted'))
+        recreated = MagicMock()
+        recreated.edit = AsyncMock(side_effect=[discord.HTTPException(MagicMock(status=500), 'error'), None])
+        hostlist_ch = MagicMock()
+        hostlist_ch.send = AsyncMock(return_value=recreated)
+        messages = [deleted]
+        task = asyncio.ensure_future(hosting.HostListObserver.publish(
+            hostlist_ch, messages, debounce=timedelta(), backoff=timedelta(milliseconds=50)))
+
+        post = hosting.ClientPostAsset(MagicMock(), 'body', hosting.Th123ClientProtocol())
+        await hosting.HostListObserver.append(post)
+        await asyncio.sleep(.01)
+        self.assertEqual(messages, [recreated])
+        hostlist_ch.send.assert_awaited_once()
+
+        post.message_body = 'edited'
+        hosting.HostListObserver.invalidate(post)
+        await asyncio.sleep(.01)
+        self.assertEqual(recreated.edit.await_count, 1)
+        await asyncio.sleep(.08)
+        self.assertEqual(recreated.edit.await_count, 2)
+        self.assertIn(':loudspeaker: edited', recreated.edit.await_args.kwargs['content'])
+
+        task.cancel()
+
+    async def test_append_keeps_one_post_per_type(self):
+        user = MagicMock(id=1)
+        first = hosting.ClientPostAsset(user, 'first', hosting.Th123ClientProtocol())
+        second = hosting.ClientPostAsset(user, 'second', hosting.Th123ClientProtocol())
+        host = hosting.HostPostAsset(user, 'host', hosting.Th123ClientProtocol())
+        self.assertIsNone(await hosting.HostListObserver.append(first))
+        self.assertIsNone(await hosting.HostListObserver.append(host))
+        self.assertIs(await hosting.HostListObserver.append(second), first)
+
+        self.assertTrue(first.terminates)
+        self.assertFalse(host.terminates)
+        self.assertEqual(list(hosting.HostListObserver._registry), [host, second])
+
+        hosting.HostListObserver.terminate(user=user)
+        self.assertEqual(hosting.HostListObserver._closing, {host, second})
+
+    async def test_reject_other_echo_packet(self):
+        ipport = networks.IpPort.create_with_str('192.0.2.0:7500')
+        protocol = hosting.Th123HostProtocol(ipport, networks.Th123Packet.packet_05())
+        post = hosting.HostPostAsset(MagicMock(id=1), 'host', protocol)
+        hosting.HostListObserver._registry.add(post)
+
+        ctx = MagicMock(send=AsyncMock())
+        cog = hosting.Hosting(MagicMock())
+        await cog.invite_as_host(ctx, MagicMock(id=2), '192.0.2.0:7500', ('rhost',), sokuroll_uses=True)
+        ctx.send.assert_awaited_once()
+        self.assertNotIn("ホストの検知を開始します。", ctx.send.await_args.args)
+        self.assertEqual(list(hosting.HostListObserver._registry), [post])
@@ -0,0 +1,19 @@
+import unittest
+
+from unittest.mock import MagicMock
+
+import get_replay_packet
+
+
+class TestTh123Watcher2HostProtocol(unittest.TestCase):
+    def setUp(self):
+        self.protocol = get_replay_packet.Th123Watcher2HostProtocol()
+        self.protocol.connection_made(MagicMock())
+
+    def test_truncated_packets_are_dropped(self):
+        addr = ('127.0.0.1', 10800)
+        for data in (bytes([0x0d, 0x04, 0x00]), bytes([0x0d, 0x09])):
+            with self.subTest(data=data):
+                self.protocol.datagram_received(data, addr)
+        self.assertFalse(self.protocol.watch_flag)
+        self.protocol.transport.sendto.assert_not_called()